@@ -35,6 +35,7 @@ setup(
     entry_points={
         'console_scripts': [
             'xapiand = xapiand.__main__:main',
+            'xapiand-bulkload = xapiand.bin.bulkload:main',
         ]
     },
     install_requires=[
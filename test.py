@@ -4,12 +4,15 @@ from __future__ import absolute_import, unicode_literals, print_function, divisi
 
 import sys
 import time
+import uuid
 import Queue
 import random
+import datetime
 import threading
 import lorem_ipsum
 
 from xapiand import Xapian
+from xapiand.serialise import LatLongCoord
 
 DATABASE = 'test'
 POOL_SIZE = 35
@@ -73,10 +76,11 @@ def usage():
     """
     Stress test Xapiand.
 
-    usage: {cmd} <build|search>
+    usage: {cmd} <build|search|protocols>
 
         build: {build}
         search: {search}
+        protocols: {protocols}
     Note: Xapiand must already be running. (To run Xapiand, use ``python -m xapiand -vv``)
 
     """
@@ -124,6 +128,42 @@ def search():
     queue.join()
 
 
+def _types(value):
+    if isinstance(value, dict):
+        return dict((k, _types(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_types(v) for v in value]
+    return type(value).__name__
+
+
+def protocols():
+    """
+        Checks results have the same types with the text and the binary protocols.
+        run as ``test.py protocols``
+
+    """
+    doc = {
+        "id": "protocols",
+        "data": {
+            "when": datetime.datetime.now().replace(microsecond=0),
+            "day": datetime.date.today(),
+            "uuid": uuid.uuid4(),
+            "where": LatLongCoord(40.4, -3.7),
+            "list": [1, 2.5, "three", {"time": datetime.time(10, 30)}],
+        },
+        "terms": [{"term": "protocols"}],
+    }
+    Xapian('localhost:8890', using=[DATABASE], durable=True).index(doc)
+    results = {}
+    for binary in (False, True):
+        client = Xapian('localhost:8890', using=[DATABASE], binary=binary)
+        results[binary] = [dict(r) for r in client.search('protocols')]
+    if _types(results[False]) != _types(results[True]):
+        print("DIFFERENT TYPES!\n  text: %r\n  binary: %r" % (_types(results[False]), _types(results[True])), file=sys.stderr)
+        sys.exit(1)
+    print("Same types in both protocols: %r" % _types(results[True]), file=sys.stderr)
+
+
 if __name__ == '__main__':
     try:
         globals()[sys.argv[1]]()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""FileQueue put benchmark.
+
+Compares writing (and fsyncing) each record on its own against grouping
+concurrent puts into a single write and fsync.
+
+Run the benchmark as
+
+  python tools/fqueue_benchmark.py [clients] [records] [window ...]
+
+where windows are given in microseconds (default: 0 200 1000).
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import gevent
+
+from xapiand.server.queue.fqueue import FileQueue
+
+
+def run(clients, records, group_window):
+    path = tempfile.mkdtemp()
+    try:
+        FileQueue.group_window = group_window
+        queue = FileQueue(name=os.path.join(path, 'benchmark'))
+        message = ('INDEX', ('file://benchmark',), (('id', {}, [], [], 'x' * 200),))
+
+        def client():
+            for i in range(records):
+                queue.put(message)
+
+        start = time.time()
+        gevent.joinall([gevent.spawn(client) for i in range(clients)])
+        return time.time() - start
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    windows = [int(w) for w in sys.argv[3:]] or [0, 200, 1000]
+    total = clients * records
+
+    print("%d clients putting %d records each" % (clients, records))
+    for label, group_window in [('per record', None)] + [('window %dus' % w, w / 1000000.0) for w in windows]:
+        duration = run(clients, records, group_window)
+        print("  %-14s %8.2fs %10.1f puts/s" % (label, duration, total / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""RedisQueue throughput benchmark.
+
+Compares one round-trip per message (put/get) against pipelined batches
+(put_many/get_many).
+
+Run the benchmark against a local redis-server as
+
+  python tools/redisqueue_benchmark.py [messages] [batch]
+
+or add --fake to use fakeredis instead.
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from xapiand.server.queue.redis import RedisQueue
+
+
+def timed(label, total, func):
+    start = time.time()
+    func()
+    duration = time.time() - start
+    print("  %-24s %8.2fs %10.1f msgs/s" % (label, duration, total / duration))
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if '--fake' in sys.argv:
+        import fakeredis
+        RedisQueue._client = fakeredis.FakeRedis()
+    messages = int(args[0]) if len(args) > 0 else 20000
+    batch = int(args[1]) if len(args) > 1 else 1000
+
+    queue = RedisQueue(name='benchmark-%s' % os.getpid())
+    queue.client.delete(*queue.keys)
+    message = ('INDEX', ('file://benchmark',), (('id', {}, [], [], 'x' * 200),))
+
+    print("%d messages, batches of %d" % (messages, batch))
+
+    def put():
+        for i in range(messages):
+            queue.put(message)
+
+    def get():
+        for i in range(messages):
+            queue.get(False)
+
+    def put_many():
+        for i in range(0, messages, batch):
+            queue.put_many([message] * min(batch, messages - i))
+
+    def get_many():
+        got = 0
+        while got < messages:
+            got += len(queue.get_many(batch, 0))
+
+    timed("put (per message)", messages, put)
+    timed("get (per message)", messages, get)
+    timed("put_many (pipelined)", messages, put_many)
+    timed("get_many (batched)", messages, get_many)
+
+
+if __name__ == '__main__':
+    main()
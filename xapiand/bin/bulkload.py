@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+
+Bulk load documents into a new database, without a server.
+
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import re
+import sys
+import time
+import zlib
+import Queue
+import shutil
+import logging
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+
+from optparse import make_option, OptionParser
+
+from xapiand import version, json
+from xapiand.core import Database, shard_endpoints, shard_endpoint
+from xapiand.parser import index_parser
+from xapiand.utils import parse_url, format_time
+from xapiand.platforms import EX_FAILURE
+from xapiand.server.compact import compact
+
+help = "Indexes documents (one JSON object per line, in the INDEX format) from the given files (or stdin) into a new database"
+args = '<endpoint> [file ...]'
+
+CHUNK_SIZE = 1000  # lines sent to a worker at a time
+REPORT_INTERVAL = 10  # seconds
+CHECK_INTERVAL = 1  # seconds waiting for workers before checking they're alive
+
+# The id as the first key of a document, to route it without decoding the document:
+DOCUMENT_ID_RE = re.compile(r'\{\s*"id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)\s*[,}]')
+
+LOG_FORMAT = "[%(asctime)s: %(levelname)s/%(processName)s] %(message)s"
+
+base_option_list = (
+    make_option('-v', '--verbosity', action='store', dest='verbosity', default='1',
+        type='choice', choices=['0', '1', '2', '3', 'v'],
+        help="Verbosity level; 0=minimal output, 1=normal output, 2=verbose output, 3=very verbose output"),
+    make_option('--pythonpath',
+        help="A directory to add to the Python path, e.g. '/home/myproject'."),
+    make_option('--traceback', action='store_true',
+        help="Print traceback on exception"),
+)
+
+option_list = (
+    make_option("-D", "--data", action='store', dest='data', default='.'),
+    make_option("-w", "--workers", action='store', dest='workers', default=None, type='int',
+        help="Number of processes building sub-databases (default: number of CPUs)"),
+    make_option("--chunk_size", action='store', dest='chunk_size', default=CHUNK_SIZE, type='int',
+        help="Documents sent to a worker at a time"),
+)
+
+
+def _local_path(endpoint, data):
+    scheme, hostname, port, username, password, path, query, query_dict = parse_url(endpoint)
+    if scheme != 'file':
+        raise ValueError("Only local databases can be bulk loaded: %s" % endpoint)
+    if path[0] not in ('/', '.'):
+        path = os.path.join(data, path)
+    return os.path.abspath(path)
+
+
+def _worker(number, endpoint, directory, chunks, results, data, log):
+    """
+    Indexes the chunks of lines into sub-databases (one per shard of the
+    endpoint) until it gets None. Puts the number of indexed documents and
+    errors in the results queue.
+
+    """
+    databases = {}
+    indexed = errors = 0
+    try:
+        for lines in iter(chunks.get, None):
+            for line in lines:
+                result = index_parser(line)
+                if not isinstance(result, tuple):
+                    log.debug("Document skipped: %s", result[3:])
+                    errors += 1
+                    continue
+                endpoints, document = result
+                db = shard_endpoint(endpoint, document[0])
+                database = databases.get(db)
+                if database is None:
+                    path = os.path.join(directory, '%s.%d' % (zlib.crc32(db.encode('utf-8')) & 0xffffffff, number))
+                    database = databases[db] = Database((path,), writable=True, create=True, data=data, log=log)
+                database.index(document)
+                indexed += 1
+        for database in databases.values():
+            database.commit()
+            database.close()
+    except Exception as exc:
+        log.exception("Worker %d ERROR: %s", number, exc)
+        results.put((number, indexed, errors, "%s" % exc))
+        for lines in iter(chunks.get, None):
+            pass  # Don't block the reader
+    else:
+        results.put((number, indexed, errors, None))
+
+
+def _document_id(line):
+    """
+    Returns the id of a JSON document, it's scanned for when it's the first
+    key, otherwise the document is decoded (with the plain JSON decoder,
+    values are only parsed by the workers).
+
+    """
+    match = DOCUMENT_ID_RE.match(line)
+    if match:
+        return json.json.loads(match.group(1))
+    return json.json.loads(line).get('id')
+
+
+def _documents(files, log):
+    """
+    Yields (document id, line) for each of the lines of the files, or
+    (None, None) for documents without an id (or where it can't be found);
+    any other invalid documents are rejected by the workers.
+
+    """
+    for fname in files or ['-']:
+        f = sys.stdin if fname == '-' else open(fname, 'rb')
+        try:
+            for num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    document_id = _document_id(line)
+                except (ValueError, AttributeError) as exc:
+                    log.error("%s:%d: Invalid document: %s", fname, num, exc)
+                    yield None, None
+                    continue
+                if document_id is None:
+                    log.error("%s:%d: Invalid document: Document must have an 'id'", fname, num)
+                    yield None, None
+                    continue
+                yield document_id, line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def _put(queue, item, process):
+    """
+    Puts item in the queue of a worker process, failing if the process
+    dies (instead of blocking forever once the queue is full).
+
+    """
+    while True:
+        try:
+            queue.put(item, True, CHECK_INTERVAL)
+            return
+        except Queue.Full:
+            if not process.is_alive():
+                raise RuntimeError("%s died (exit code %s)" % (process.name, process.exitcode))
+
+
+def _results(results, processes):
+    """
+    Yields the results of all the worker processes, failing if any of them
+    dies without putting its results.
+
+    """
+    pending = set(range(len(processes)))
+    dead = set()
+    while pending:
+        try:
+            result = results.get(True, CHECK_INTERVAL)
+        except Queue.Empty:
+            died = set(number for number in pending if not processes[number].is_alive())
+            # Results put just before exiting can still be on their way:
+            for number in died & dead:
+                raise RuntimeError("%s died (exit code %s)" % (processes[number].name, processes[number].exitcode))
+            dead |= died
+            continue
+        pending.discard(result[0])
+        yield result
+
+
+def bulkload(endpoint, files, data='.', workers=None, chunk_size=CHUNK_SIZE, log=logging):
+    """
+    Indexes the documents in the files into sub-databases (in parallel) and
+    merges them into the (new) database of the endpoint.
+
+    Documents are distributed among the workers by id, so a document id
+    repeated in the input ends up indexed just once (the last one).
+    Documents without an id are rejected (counted as errors).
+
+    """
+    workers = workers or multiprocessing.cpu_count()
+    endpoints = shard_endpoints(endpoint)
+    paths = [_local_path(db, data) for db in endpoints]
+    for path in paths:
+        if os.path.exists(path):
+            raise ValueError("Database already exists: %s" % path)
+    directory = '%s.bulkload-%s' % (paths[0], os.getpid())
+    os.makedirs(directory)
+
+    try:
+        # Stage 1: build the sub-databases
+        start = time.time()
+        results = multiprocessing.Queue()
+        queues = [multiprocessing.Queue(4) for i in range(workers)]
+        processes = [multiprocessing.Process(target=_worker, args=(i, endpoint, directory, queues[i], results, data, log), name='Loader-%d' % i) for i in range(workers)]
+        for process in processes:
+            process.start()
+
+        try:
+            read = rejected = 0
+            report = start
+            chunks = [[] for i in range(workers)]
+            for document_id, line in _documents(files, log):
+                if document_id is None:
+                    rejected += 1
+                    continue
+                number = (zlib.crc32(('%s' % document_id).encode('utf-8')) & 0xffffffff) % workers
+                chunk = chunks[number]
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    _put(queues[number], chunk, processes[number])
+                    chunks[number] = []
+                read += 1
+                now = time.time()
+                if now - report > REPORT_INTERVAL:
+                    report = now
+                    log.info("Read %d documents ~ %d docs/sec", read, read / (now - start))
+            for number, chunk in enumerate(chunks):
+                if chunk:
+                    _put(queues[number], chunk, processes[number])
+                _put(queues[number], None, processes[number])
+
+            indexed, errors = 0, rejected
+            failed = None
+            for number, _indexed, _errors, exc in _results(results, processes):
+                indexed += _indexed
+                errors += _errors
+                failed = failed or exc
+        except BaseException:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            raise
+        for process in processes:
+            process.join()
+        if failed:
+            raise RuntimeError(failed)
+        duration = time.time() - start
+        log.info("Indexed %d documents (%d errors) into %d sub-databases in %s ~ %d docs/sec", indexed, errors, len(os.listdir(directory)), format_time(duration), indexed / duration if duration else 0)
+
+        # Stage 2: merge the sub-databases of each shard
+        start = time.time()
+        for db, path in zip(endpoints, paths):
+            prefix = '%s.' % (zlib.crc32(db.encode('utf-8')) & 0xffffffff)
+            sources = sorted(os.path.join(directory, fname) for fname in os.listdir(directory) if fname.startswith(prefix))
+            if sources:
+                parent = os.path.dirname(path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                compact(sources, path, renumber=True)
+        duration = time.time() - start
+        log.info("Merged %d documents into %d database%s in %s ~ %d docs/sec", indexed, len(paths), '' if len(paths) == 1 else 's', format_time(duration), indexed / duration if duration else 0)
+        return indexed, errors
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(*argv, **options):
+    if not argv:
+        print >>sys.stderr, "You must specify the endpoint of the database"
+        return EX_FAILURE
+
+    verbosity = options['verbosity']
+    loglevel = ['WARNING', 'INFO', 'DEBUG', 'DEBUG'][3 if verbosity == 'v' else int(verbosity)]
+    logging.basicConfig(format=LOG_FORMAT, level=loglevel)
+    log = logging.getLogger()
+
+    endpoint, files = argv[0], argv[1:]
+    try:
+        bulkload(endpoint, files, data=options['data'], workers=options['workers'], chunk_size=options['chunk_size'], log=log)
+    except Exception as exc:
+        if options.get('traceback'):
+            raise
+        log.error("%s", exc)
+        return EX_FAILURE
+
+
+def main():
+    usage = 'usage: %%prog [options] %s' % args
+    if help:
+        usage = '%s\n\n%s' % (usage, help)
+    parser = OptionParser(usage,
+                          version=version,
+                          option_list=base_option_list + option_list)
+
+    options, argv = parser.parse_args(sys.argv[1:])
+    if options.pythonpath:
+        sys.path.insert(0, options.pythonpath)
+
+    sys.exit(run(*argv, **options.__dict__))
+
+if __name__ == '__main__':
+    main()
@@ -42,17 +42,36 @@ option_list = (
     make_option("--detach", action='store_true', dest="detach", default=False,
         help="Detach process"),
     make_option("--queue", action='store', dest='queue_type', default='memory',
-        type='choice', choices=['memory', 'file', 'redis'],
-        help="Queue type; memory=Memory queue (default), file=File based queue (persistent)"),
+        type='choice', choices=['memory', 'file', 'sqlite', 'redis'],
+        help="Queue type; memory=Memory queue (default), file=File based queue (persistent), sqlite=SQLite based queue (persistent)"),
     make_option("-t", "--commit_timeout", action='store', dest='commit_timeout', default=1, type='int'),
     make_option("--commit_slots", action='store', dest='commit_slots', default=None, type='int'),
+    make_option("--commit_docs", action='store', dest='commit_docs', default=None, type='int',
+        help="Commit after this many pending documents"),
+    make_option("--commit_bytes", action='store', dest='commit_bytes', default=None, type='int',
+        help="Commit after this many (estimated) pending bytes"),
+    make_option("--prepare_workers", action='store', dest='prepare_workers', default=None, type='int',
+        help="Number of processes preparing documents for the writers (disabled by default)"),
+    make_option("--writer_threads", action='store', dest='writer_threads', default=None, type='int',
+        help="Number of threads serving the writer queues"),
+    make_option("--writer_handles", action='store', dest='writer_handles', default=None, type='int',
+        help="Maximum number of writable databases kept open"),
+    make_option("--group_window", action='store', dest='group_window', default=None, type='int',
+        help="Microseconds file queue puts wait to share a single write and fsync"),
+    make_option("--queue_high", action='store', dest='queue_high', default=None, type='int',
+        help="Documents waiting in a writer queue before rejecting new changes (bulk commands count for their documents)"),
+    make_option("--queue_low", action='store', dest='queue_low', default=None, type='int',
+        help="Documents waiting in a writer queue to accept changes again"),
+    make_option("--compact_nice", action='store', dest='compact_nice', default=None, type='int',
+        help="Niceness (CPU and I/O priority) of database compactions (0-19)"),
 )
 
 
 def detach(path, argv, logfile=None, pidfile=None, uid=None, gid=None, umask=0,
            working_directory=None, fake=False, verbosity=None, data=None,
            listener=None, queue_type=None, commit_timeout=None, commit_slots=None,
-           **options):
+           commit_docs=None, commit_bytes=None, prepare_workers=None, writer_threads=None,
+           writer_handles=None, group_window=None, queue_high=None, queue_low=None, compact_nice=None, **options):
     with detached(logfile, pidfile, uid, gid, umask, working_directory, fake):
         try:
             args = list(argv)
@@ -72,6 +91,24 @@ def detach(path, argv, logfile=None, pidfile=None, uid=None, gid=None, umask=0,
                 args.append('--commit_timeout=%s' % commit_timeout)
             if commit_slots is not None:
                 args.append('--commit_slots=%s' % commit_slots)
+            if commit_docs is not None:
+                args.append('--commit_docs=%s' % commit_docs)
+            if commit_bytes is not None:
+                args.append('--commit_bytes=%s' % commit_bytes)
+            if prepare_workers is not None:
+                args.append('--prepare_workers=%s' % prepare_workers)
+            if writer_threads is not None:
+                args.append('--writer_threads=%s' % writer_threads)
+            if writer_handles is not None:
+                args.append('--writer_handles=%s' % writer_handles)
+            if group_window is not None:
+                args.append('--group_window=%s' % group_window)
+            if queue_high is not None:
+                args.append('--queue_high=%s' % queue_high)
+            if queue_low is not None:
+                args.append('--queue_low=%s' % queue_low)
+            if compact_nice is not None:
+                args.append('--compact_nice=%s' % compact_nice)
             os.execv(path, [path] + args)
         except Exception:
             print >>sys.stderr, "Can't exec %r" % ' '.join([path] + args)
@@ -1,8 +1,10 @@
 from __future__ import absolute_import, unicode_literals, print_function
 
+import re
 import sys
 import time
 import Queue
+import marshal
 import socket
 import weakref
 import contextlib
@@ -11,8 +13,8 @@ from errno import EISCONN, EINVAL, ECONNREFUSED
 from functools import wraps
 
 from ..parser import SPLIT_RE
-from ..exceptions import ConnectionError, NewConnection
-from ..utils import sendall, readline
+from ..exceptions import ConnectionError, NewConnection, BusyError
+from ..utils import sendall, pack_frame, SocketReader
 
 
 # Sentinel used to mark an empty slot in the ConnectionPool queue.
@@ -20,6 +22,9 @@ from ..utils import sendall, readline
 # sort *after* live connection objects in the queue.
 EMPTY_SLOT = (sys.maxint, None)
 
+# Reply of the server when a writer has too many pending changes.
+BUSY_RE = re.compile(r'^>> ERR: \[503\] (.*?retry after (\d+).*)$')
+
 
 def command(func=False, **kwargs):
     def _command(func):
@@ -114,6 +119,11 @@ def with_retry(func):
                 return func(self, *args, **kw)
             except NewConnection:
                 continue
+            except BusyError as exc:
+                exc_info = sys.exc_info()
+                self.sleep(max(delay, exc.retry_after))
+                retries += 1
+                delay *= 3  # growing the delay
             except (IOError, RuntimeError, socket.error, ConnectionError):
                 exc_info = sys.exc_info()
                 self.sleep(delay)
@@ -131,7 +141,7 @@ class Connection(object):
     def __init__(self, host='localhost', port=8890, endpoints=None,
                  max_connect_retries=5, reconnect_delay=0.1,
                  socket_timeout=4, encoding='utf-8', encoding_errors='strict',
-                 socket_class=socket.socket, sleep=time.sleep):
+                 socket_class=socket.socket, sleep=time.sleep, binary=False):
         self.socket_class = socket_class
         self.sleep = sleep
         self.host = host
@@ -144,6 +154,8 @@ class Connection(object):
         self.encoding_errors = encoding_errors
         self.client_socket = None
         self.cmd_id = 0
+        self.binary = binary  # use the binary protocol (if the server supports it)
+        self._binary = False
 
     def __del__(self):
         try:
@@ -156,7 +168,6 @@ class Connection(object):
         if self._checkout:
             pool, ts = self._checkout
             self._checkout = None
-            self._client_responses_socket = None
             self.cmd_id += 1
             pool._checkin_connection(ts, self)
 
@@ -177,11 +188,11 @@ class Connection(object):
         pass
 
     @property
-    def client_responses(self):
-        if not hasattr(self, '_client_responses') or getattr(self, '_client_responses_socket', None) != self.client_socket:
-            self._client_responses_socket = self.client_socket
-            self._client_responses = readline(self._client_responses_socket)
-        return self._client_responses
+    def reader(self):
+        if getattr(self, '_reader_socket', None) is not self.client_socket:
+            self._reader_socket = self.client_socket
+            self._reader = SocketReader(self.client_socket, encoding=self.encoding, encoding_errors=self.encoding_errors)
+        return self._reader
 
     def connect(self):
         if not self.client_socket:
@@ -193,8 +204,16 @@ class Connection(object):
                 raise ConnectionError(self._error_message(e)), None, exc_info[2]
             self.client_socket = sock
         self.cmd_id = 0
+        if self.binary and not self._binary:
+            self._binary = self._negotiate()
         self.on_connect()
 
+    def _negotiate(self):
+        "Switches the connection to the binary protocol"
+        self.cmd_id += 1
+        self.send(self.pack_command('PROTOCOL', 'BINARY'))
+        return self.read() == '>> OK'
+
     def _connect(self):
         "Create a TCP socket connection"
         sock = self.socket_class(socket.AF_INET, socket.SOCK_STREAM)
@@ -225,6 +244,7 @@ class Connection(object):
         "Disconnects from the server"
         self.on_disconnect()
         self.cmd_id = 0
+        self._binary = False
         client_socket, self.client_socket = self.client_socket, None
         if client_socket is not None:
             try:
@@ -239,7 +259,10 @@ class Connection(object):
             raise NewConnection("New connection made!")
         # print('<<<<---', id(self), '%s:%s' % (self.address[0], self.address[1]), repr(body), file=sys.stderr)
         try:
-            sendall(self.client_socket, body)
+            if isinstance(body, bytes):
+                self.client_socket.sendall(body)
+            else:
+                sendall(self.client_socket, body)
         except socket.error:
             self.disconnect()
             exc_info = sys.exc_info()
@@ -256,7 +279,11 @@ class Connection(object):
     def read(self):
         "Read the response from a previously sent command"
         cmd_id = self.cmd_id
-        for response in self.client_responses:
+        if self._binary:
+            return self._read_frame(cmd_id)
+        reader = self.reader
+        while True:
+            response = reader.readline()
             if not response:
                 self.disconnect()
                 raise ConnectionError("No response!")
@@ -280,15 +307,46 @@ class Connection(object):
                 break
         return response
 
+    def _read_frame(self, cmd_id):
+        while True:
+            try:
+                frame = self.reader.read_frame()
+            except ValueError as e:
+                self.disconnect()
+                raise ConnectionError("Received a wrong response from the server: %s" % e)
+            if frame is None:
+                self.disconnect()
+                raise ConnectionError("No response!")
+            try:
+                _cmd_id, response = marshal.loads(frame)
+            except (ValueError, TypeError, EOFError):
+                self.disconnect()
+                raise ConnectionError("Received a wrong response from the server: %r" % frame[:100])
+            if isinstance(response, basestring) and response[:1] in ("#", " "):
+                continue
+            if _cmd_id != cmd_id:
+                if _cmd_id < cmd_id:
+                    continue
+                self.disconnect()
+                raise ConnectionError("Old command handler read a newer message sequence!")
+            return response
+
     def pack_command(self, *args):
-        return "%s%s" % (" ".join(a for a in args if a), self.delimiter)
+        command = " ".join(a for a in args if a)
+        if self._binary:
+            return pack_frame(command.encode(self.encoding, self.encoding_errors))
+        return "%s%s" % (command, self.delimiter)
 
     @with_retry
     def execute_command(self, command_name, *args):
         self.cmd_id += 1
         command = self.pack_command(command_name, *args)
         self.send(command)
-        return self.read()
+        response = self.read()
+        busy = isinstance(response, basestring) and BUSY_RE.match(response)
+        if busy:
+            raise BusyError(busy.group(1), int(busy.group(2)))
+        return response
 
     @property
     def address(self):
@@ -317,6 +375,8 @@ class ServerPool(object):
     :param: reconnect_delay: how long will a connection wait before
             retrying to reconnect.
     :param: socket_timeout: socket timeout for operations.
+    :param: binary: use the binary protocol (falls back to the text protocol
+            if the server doesn't support it).
 
     """
     connection_class = Connection
@@ -325,7 +385,7 @@ class ServerPool(object):
                  wait_for_connection=None, max_age=60,
                  max_connect_retries=2, reconnect_delay=0.1,
                  socket_timeout=4, socket_class=socket.socket, sleep=time.sleep,
-                 encoding='utf-8', encoding_errors='strict'):
+                 encoding='utf-8', encoding_errors='strict', binary=False):
         self.socket_class = socket_class
         self.sleep = sleep
         self.max_connect_retries = max_connect_retries
@@ -334,6 +394,7 @@ class ServerPool(object):
         self.blacklist_time = blacklist_time
         self.encoding = encoding
         self.encoding_errors = encoding_errors
+        self.binary = binary
         self._blacklist = {}
         self._pick_index = 0
         self._pool = ConnectionPool(
@@ -385,6 +446,7 @@ class ServerPool(object):
                 encoding_errors=self.encoding_errors,
                 socket_class=self.socket_class,
                 sleep=self.sleep,
+                binary=self.binary,
             )
             try:
                 connection.connect()
@@ -3,9 +3,9 @@ from __future__ import absolute_import, unicode_literals
 import logging
 
 from .. import version
-from ..core import DatabasesPool
+from ..core import DatabasesPool, shard_endpoints, shard_endpoint, DELETE_QUERY_LIMIT
 from ..parser import index_parser, search_parser
-from ..search import Search
+from ..search import Search, results_cache
 from ..exceptions import XapianError
 from ..results import XapianResults
 
@@ -79,7 +79,8 @@ class Xapian(object):
                 get_terms=get_terms,
                 get_size=get_size,
                 data=self.data,
-                log=self.log)
+                log=self.log,
+                cache=results_cache)
             return search
 
     def facets(self, search, *facets, **kwargs):
@@ -190,8 +191,9 @@ class Xapian(object):
     def _delete(self, id, commit):
         self._check_db()
         reopen, self._do_reopen = self._do_reopen, False
-        with self.databases_pool.database(self.active_endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
-            database.delete(commit=commit)
+        endpoints = tuple(shard_endpoint(endpoint, id) for endpoint in self.active_endpoints)
+        with self.databases_pool.database(endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
+            database.delete(id, commit=commit)
 
     def delete(self, id):
         self._delete(id, False)
@@ -199,6 +201,36 @@ class Xapian(object):
     def cdelete(self, id):
         self._delete(id, True)
 
+    def _delete_query(self, search, terms, ranges, partials, commit):
+        self._check_db()
+        query = search_parser(search)
+        if terms is not None:
+            query['terms'] = terms
+        if ranges is not None:
+            query['ranges'] = ranges
+        if partials is not None:
+            query['partials'] = partials
+        reopen, self._do_reopen = self._do_reopen, False
+        deleted = 0
+        for endpoint in self.active_endpoints:
+            for db in shard_endpoints(endpoint):
+                with self.databases_pool.database((db,), writable=True, create=self._do_create, reopen=reopen) as database:
+                    max_docid = database.database.get_lastdocid()
+                    while True:
+                        batch = database.delete_query(query, DELETE_QUERY_LIMIT, max_docid)
+                        deleted += batch
+                        if batch < DELETE_QUERY_LIMIT:
+                            break
+                    if commit:
+                        database.commit()
+        return deleted
+
+    def delete_query(self, search=None, terms=None, ranges=None, partials=None):
+        return self._delete_query(search, terms, ranges, partials, False)
+
+    def cdelete_query(self, search=None, terms=None, ranges=None, partials=None):
+        return self._delete_query(search, terms, ranges, partials, True)
+
     def _index(self, obj, commit, **kwargs):
         result = index_parser(obj or kwargs)
         if not isinstance(result, tuple):
@@ -208,6 +240,7 @@ class Xapian(object):
             endpoints = self.active_endpoints
         if not endpoints:
             self._check_db()
+        endpoints = tuple(shard_endpoint(endpoint, document[0]) for endpoint in endpoints)
         reopen, self._do_reopen = self._do_reopen, False
         with self.databases_pool.database(endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
             database.index(document, commit=commit)
@@ -219,8 +252,38 @@ class Xapian(object):
         obj = obj or kwargs
         self._index(obj, True, **kwargs)
 
+    def _bulk_index(self, objs, commit):
+        statuses = []
+        batches = {}
+        for i, obj in enumerate(objs):
+            document_id = obj.get('id') if isinstance(obj, dict) else None
+            result = index_parser(obj)
+            if isinstance(result, tuple):
+                endpoints, document = result
+                endpoints = endpoints or self.active_endpoints
+                if not endpoints:
+                    self._check_db()
+                endpoints = tuple(shard_endpoint(endpoint, document[0]) for endpoint in endpoints)
+                batches.setdefault(endpoints, []).append(document)
+                statuses.append({'index': i, 'id': document_id, 'status': 'OK'})
+            else:
+                statuses.append({'index': i, 'id': document_id, 'status': 'ERR', 'error': result[8:]})
+        reopen, self._do_reopen = self._do_reopen, False
+        for endpoints, documents in batches.items():
+            with self.databases_pool.database(endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
+                database.bulk_index(documents, commit=commit)
+        return statuses
+
+    def bulk_index(self, objs):
+        return self._bulk_index(objs, False)
+
+    def cbulk_index(self, objs):
+        return self._bulk_index(objs, True)
+
     def commit(self):
         self._check_db()
         reopen, self._do_reopen = self._do_reopen, False
-        with self.databases_pool.database(self.active_endpoints, writable=True, create=self._do_create, reopen=reopen) as database:
-            database.commit()
+        for endpoint in self.active_endpoints:
+            for db in shard_endpoints(endpoint):
+                with self.databases_pool.database((db,), writable=True, create=self._do_create, reopen=reopen) as database:
+                    database.commit()
@@ -9,14 +9,24 @@ from ..results import XapianResults
 from .connection import Connection, ServerPool, command
 
 
-def dumps(obj, **kwargs):
+def _clean(obj):
     if isinstance(obj, dict):
         obj = dict((k, v) for k, v in obj.items() if v)
+    return obj
+
+
+def dumps(obj, **kwargs):
+    if isinstance(obj, list):
+        obj = [_clean(o) for o in obj]
+    else:
+        obj = _clean(obj)
     return json.dumps(obj, **kwargs)
 
 
 class XapianConnection(Connection):
     _endpoints = None
+    _durable = False
+    _raw_data = False
 
     def get_name(self):
         if self.endpoints:
@@ -25,6 +35,13 @@ class XapianConnection(Connection):
             return ""
 
     def on_connect(self):
+        # The modes of the connection are restored when reconnecting:
+        if self._durable:
+            self._durable = False
+            self.durable()
+        if self._raw_data:
+            self._raw_data = False
+            self.raw()
         if self._endpoints:
             endpoints, self._endpoints = self._endpoints, None
             self.using(endpoints)
@@ -65,6 +82,8 @@ class XapianConnection(Connection):
             self._response(self.execute_command('USING'))
 
     def _response(self, line):
+        if not isinstance(line, basestring):
+            return  # A result (binary protocol)
         if line.startswith(">> "):
             if line.startswith(">> OK"):
                 return line[7:]
@@ -78,9 +97,21 @@ class XapianConnection(Connection):
             response = self._response(line)
             if response is not None:
                 break
-            yield json.loads(line)
+            yield self._result(line)
             line = self.read()
 
+    def _result(self, line):
+        if isinstance(line, dict):  # Binary protocol
+            if self._raw_data and 'data' in line:
+                # The data is the stored JSON, as it is:
+                raw_data = line.pop('data')
+                result = json.unsimplify(line)
+                result['data'] = json.loads(raw_data)
+                return result
+            return json.unsimplify(line)
+        # Raw data is spliced as JSON, so results are decoded as usual:
+        return json.loads(line)
+
     @command
     def facets(self, search, *facets, **kwargs):
         terms = kwargs.get('terms')
@@ -188,6 +219,24 @@ class XapianConnection(Connection):
     def cdelete(self, id):
         return self._response(self.execute_command('CDELETE', id))
 
+    def _delete_query(self, cmd, search, terms, ranges, partials):
+        query = search_parser(search)
+        if terms is not None:
+            query['terms'] = terms
+        if ranges is not None:
+            query['ranges'] = ranges
+        if partials is not None:
+            query['partials'] = partials
+        return self._response(self.execute_command(cmd, dumps(query, ensure_ascii=False)))
+
+    @command
+    def delete_query(self, search=None, terms=None, ranges=None, partials=None):
+        return self._delete_query('DELETEQUERY', search, terms, ranges, partials)
+
+    @command
+    def cdelete_query(self, search=None, terms=None, ranges=None, partials=None):
+        return self._delete_query('CDELETEQUERY', search, terms, ranges, partials)
+
     def _index(self, cmd, obj, **kwargs):
         return self._response(self.execute_command(cmd, dumps(obj or kwargs, ensure_ascii=False)))
 
@@ -199,6 +248,25 @@ class XapianConnection(Connection):
     def cindex(self, obj=None, **kwargs):
         return self._index('CINDEX', obj, **kwargs)
 
+    def _bulk_index(self, cmd, objs):
+        line = self.execute_command(cmd, dumps(list(objs), ensure_ascii=False))
+        statuses = []
+        while line:
+            response = self._response(line)
+            if response is not None:
+                break
+            statuses.append(json.unsimplify(line) if isinstance(line, dict) else json.loads(line))
+            line = self.read()
+        return statuses
+
+    @command
+    def bulk_index(self, objs):
+        return self._bulk_index('BINDEX', objs)
+
+    @command
+    def cbulk_index(self, objs):
+        return self._bulk_index('CBINDEX', objs)
+
     @command
     def commit(self):
         return self._response(self.execute_command('COMMIT'))
@@ -215,6 +283,18 @@ class XapianConnection(Connection):
     def weak(self):
         return self._response(self.execute_command('WEAK'))
 
+    @command
+    def durable(self, on=True):
+        response = self._response(self.execute_command('DURABLE', 'ON' if on else 'OFF'))
+        self._durable = on
+        return response
+
+    @command
+    def raw(self, on=True):
+        response = self._response(self.execute_command('RAW', 'ON' if on else 'OFF'))
+        self._raw_data = on
+        return response
+
 
 class Xapian(ServerPool):
     connection_class = XapianConnection
@@ -223,12 +303,19 @@ class Xapian(ServerPool):
         self._using = kwargs.pop('using', None)
         self._open = kwargs.pop('open', None)
         self._weak = kwargs.pop('weak', False)
+        self._durable = kwargs.pop('durable', False)
+        self._raw_data = kwargs.pop('raw_data', False)
         super(Xapian, self).__init__(*args, **kwargs)
 
     def call(self, name, *args, **kwargs):
         def callback(xapian):
             if self._weak:
                 xapian.weak()
+            # Modes are only sent when the connection doesn't have them yet:
+            if xapian._durable != self._durable:
+                xapian.durable(self._durable)
+            if xapian._raw_data != self._raw_data:
+                xapian.raw(self._raw_data)
             if self._using:
                 xapian.using(self._using)
             elif self._open:
@@ -202,7 +202,19 @@ class XapianSearchBackend(BaseSearchBackend):
         async(self.xapian)(callback)
 
     def clear(self, models=[], commit=True):
-        pass
+        endpoints = self.endpoints.for_read(models=models)
+        if not endpoints:
+            return
+
+        def callback(xapian):
+            xapian.using(endpoints)
+            delete_query = xapian.cdelete_query if commit else xapian.delete_query
+            if models:
+                for model in models:
+                    delete_query(terms='%s:%s.%s' % (DJANGO_CT.upper(), model._meta.app_label, model._meta.module_name))
+            else:
+                delete_query('*')
+        self.xapian(callback)
 
     @log_query
     def search(self, query_string, start_offset, end_offset=None, ranges=None,
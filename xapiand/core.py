@@ -17,7 +17,7 @@ import xapian
 
 from .exceptions import XapianError, InvalidIndexError
 from .serialise import serialise_value, normalize
-from .utils import parse_url, build_url
+from .utils import parse_url, build_url, MemoizedTable
 from .platforms import pid_exists
 
 DATABASE_MAX_LIFE = 900  # 900 = stop writer after 15 minutes of inactivity
@@ -25,6 +25,13 @@ DATABASE_SHORT_LIFE = max(DATABASE_MAX_LIFE - 60, DATABASE_MAX_LIFE - DATABASE_M
 
 MIN_TCP_SERVER_PORTS = 100
 
+SLOTS_CACHE_SIZE = 10000
+SHARDS_CACHE_SIZE = 1000
+
+DELETE_QUERY_LIMIT = 1000  # documents deleted at a time by delete_query()
+
+SHARDS_SCHEME = 'shards'
+
 DOCUMENT_ID_TERM_PREFIX = 'Q'
 DOCUMENT_CUSTOM_TERM_PREFIX = 'X'
 
@@ -78,7 +85,7 @@ def expand_terms(value, field=None, connector=' AND '):
     return value
 
 
-def get_slot(name):
+def _get_slot(name):
     if KEY_RE.match(name):
         _name = name.lower()
         if _name != name:
@@ -89,12 +96,27 @@ def get_slot(name):
         return slot
 
 
-def get_prefix(name, prefix=''):
-    slot = get_slot(name)
+slots = MemoizedTable(_get_slot, SLOTS_CACHE_SIZE)
+
+
+def _get_prefix(key):
+    name, prefix = key
+    slot = slots(name)
     slot = '{:x}'.format(slot).upper()
     return '%s%s:' % (prefix, slot)
 
 
+prefixes = MemoizedTable(_get_prefix, SLOTS_CACHE_SIZE)
+
+
+def get_slot(name):
+    return slots(name)
+
+
+def get_prefix(name, prefix=''):
+    return prefixes((name, prefix))
+
+
 def prefixed(term, prefix=''):
     prefix = prefix.upper()
     prefix1 = prefix and prefix[-1]
@@ -105,6 +127,73 @@ def prefixed(term, prefix=''):
         return prefix + ':' + term
 
 
+def _get_shards(endpoint):
+    scheme, hostname, port, username, password, path, query, query_dict = parse_url(endpoint)
+    if scheme != SHARDS_SCHEME:
+        return (build_url(scheme, hostname, port, username, password, path, query, query_dict),)
+    try:
+        num = int(query_dict.get('n', ''))
+    except ValueError:
+        num = 0
+    if num < 1:
+        raise InvalidIndexError("Sharded endpoint needs the number of shards (?n=N): %s" % endpoint)
+    if hostname and path:
+        scheme = 'xapian'  # Remote shards (in the default port if none given)
+    else:
+        # Local shards: shards://name (relative to the data directory) or
+        # shards:///path/to/name (absolute):
+        path = hostname or ('/' + path if path else None)
+        scheme, hostname, port, username, password = 'file', None, None, None, None
+    if not path:
+        raise InvalidIndexError("Sharded endpoint needs a name: %s" % endpoint)
+    endpoints = (build_url(scheme, hostname, port, username, password, '%s/%d' % (path, i), '', {}) for i in range(num))
+    return tuple(build_url(*parse_url(db)) for db in endpoints)
+
+
+shards = MemoizedTable(_get_shards, SHARDS_CACHE_SIZE)
+
+
+def shard_endpoints(endpoint):
+    """
+    Returns the (canonical) endpoints of the physical databases behind an
+    endpoint: ``shards://name?n=N`` (or ``shards://host:port/name?n=N``)
+    stands for the N databases ``name/0`` ... ``name/<N-1>``, any other
+    endpoint for itself.
+
+    """
+    return shards(endpoint.strip())
+
+
+def shard_endpoint(endpoint, document_id):
+    """
+    Returns the endpoint of the shard (of a sharded endpoint) which holds
+    the document with the given id.
+
+    """
+    endpoints = shard_endpoints(endpoint)
+    if len(endpoints) == 1:
+        return endpoints[0]
+    shard = int(md5(('%s' % document_id).encode('utf-8')).hexdigest()[:8], 16) % len(endpoints)
+    return endpoints[shard]
+
+
+def _query_term(xquery):
+    """
+    Returns the term of a query matching the documents with a single term
+    (such as the boolean filters of the query parser, wrapped to scale
+    their weight), None for any other query.
+
+    """
+    if getattr(xapian.Query, 'LEAF_TERM', None) is None:
+        return None  # Queries can't be inspected
+    wrappers = (xapian.Query.OP_SCALE_WEIGHT, xapian.Query.OP_FILTER, xapian.Query.OP_AND, xapian.Query.OP_OR)
+    while xquery.get_type() in wrappers and xquery.get_num_subqueries() == 1:
+        xquery = xquery.get_subquery(0)
+    if xquery.get_type() != xapian.Query.LEAF_TERM:
+        return None
+    return next(iter(xquery))
+
+
 def _spawn_tcpservers(endpoints, data='.', log=logging):
     from . import Xapian
 
@@ -430,12 +519,13 @@ class DatabasesPool(CleanablePool):
     @contextmanager
     def database(self, endpoints, writable, create=False, reopen=False):
         """
-        Returns a xapian.Database with multiple endpoints attached.
+        Returns a xapian.Database with multiple endpoints attached (all the
+        shards of sharded endpoints).
 
         """
         database = None
         new = False
-        endpoints = tuple(build_url(*parse_url(db.strip())) for db in endpoints)
+        endpoints = tuple(db for endpoint in endpoints for db in shard_endpoints(endpoint))
 
         with self.lock:
             pool_queue = self.setdefault((writable, endpoints), DatabasesPoolQueue())
@@ -460,13 +550,32 @@ class DatabasesPool(CleanablePool):
             with pool_queue.lock:
                 if database:
                     pool_queue.used.discard(database)
-                    if len(pool_queue.unused) < 10:
+                    if len(pool_queue.unused) < 10 and not pool_queue.cleaned:
                         if not database.database._closed:
                             pool_queue.unused.append(database)
                     else:
                         database.close()
                 pool_queue.time = time.time()
 
+    def invalidate(self, endpoint):
+        """
+        Removes the databases using the endpoint from the pool (after its
+        files have been replaced), so they're opened again. Databases being
+        used are closed once they're released.
+
+        """
+        endpoint = build_url(*parse_url(endpoint.strip()))
+        invalidated = []
+        with self.lock:
+            for key, pool_queue in list(self.items()):
+                writable, endpoints = key
+                if endpoint in endpoints:
+                    invalidated.append(pool_queue)
+                    del self[key]
+        for pool_queue in invalidated:
+            with pool_queue.lock:
+                pool_queue.cleanup(data=self.data, log=self.log)
+
 
 class TcpPool(CleanablePool):
     def __init__(self, *args, **kwargs):
@@ -494,73 +603,47 @@ class TcpPool(CleanablePool):
 tcpservers = TcpPool()
 
 
-class Database(object):
-    def __init__(self, endpoints, writable, create, data='.', log=logging):
-        self.writable = writable
-        self.create = create
-        self.data = data
-        self.log = log
-        self.database = _xapian_database(endpoints, writable, create, data=data, log=log)
-
-    def __str__(self):
-        return self.database._db
+class DocumentBuilder(object):
+    database = None
 
-    def close(self):
-        database = self.database
-        if database._closed:
-            return
-
-        subdatabases = database._subdatabases
-
-        # Could not be opened, try full reopen:
-        endpoints = database._endpoints
-
-        # Remove database from pool
-        _database = subdatabases.pop((self.writable, endpoints), None)
-        assert not _database or _database == database
-        # ...and close.
-        if database:
-            database.close()
-
-        # Subdatabases cleanup:
-        for subdatabase in database._all_databases:
-            subdatabase_number = database._all_databases.index(subdatabase)
-            db, writable, create = database._all_databases_config[subdatabase_number]
-            scheme, hostname, port, username, password, path, query, query_dict = parse_url(db)
-            key = (scheme, hostname, port, username, password, path)
-
-            # Remove subdatabase from pool
-            _subdatabase = subdatabases.pop((writable, key), None)
-            assert not _subdatabase or _subdatabase == subdatabase
-            # ...and close (close on the main database should have already closed it anyway).
-            if subdatabase:
-                subdatabase.close()
-
-        database._closed = True
-        self.log.debug("Database %s: %s", "closed", database._db)
+    def __init__(self, log=logging):
+        self.log = log
+        self._term_generators = {}
+        self._stemmers = {}
 
-    def reopen(self, force=False):
-        database = self.database
+    def get_stemmer(self, language):
         try:
-            if database._closed:
-                raise xapian.DatabaseError("Already closed database")
-            database.reopen()
+            stemmer = self._stemmers[language]
+        except KeyError:
+            stemmer = self._stemmers[language] = xapian.Stem(language)
+        return stemmer
 
-        except (xapian.NetworkError, xapian.DatabaseError) as exc:
-            # Could not be opened, try full reopen:
-            self.log.error("xapian_reopen database: %s", exc)
-            force = True
+    def get_term_generator(self, language, spelling):
+        """
+        Returns a configured term generator (re-used across documents).
 
-        if force:
-            self.close()
-            endpoints = database._endpoints
-            database = _xapian_database(endpoints, self.writable, self.create, data=self.data, log=self.log)
-            self.database = database
+        """
+        key = (language, spelling)
+        try:
+            term_generator = self._term_generators[key]
+        except KeyError:
+            term_generator = xapian.TermGenerator()
+            if spelling:
+                if self.database is None:
+                    raise XapianError("Spelling needs a database")
+                term_generator.set_database(self.database)
+                term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+            if language:
+                term_generator.set_stemmer(self.get_stemmer(language))
+            self._term_generators[key] = term_generator
+        return term_generator
 
-        return database
+    def build(self, document):
+        """
+        Builds a xapian.Document from a document (as returned by index_parser)
+        and returns it together with its document id (or id term).
 
-    def index(self, document, commit=False):
-        database = self.database
+        """
         document_id, document_values, document_terms, document_texts, document_data, default_language, default_spelling, default_positions = document
 
         document = xapian.Document()
@@ -628,21 +711,134 @@ class Database(object):
             positions = default_positions if positions is None else positions
             spelling = default_spelling if spelling is None else spelling
 
-            term_generator = xapian.TermGenerator()
+            term_generator = self.get_term_generator(language, bool(spelling))
             term_generator.set_document(document)
-            if spelling:
-                term_generator.set_database(database)
-                term_generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
-            if language:
-                term_generator.set_stemmer(xapian.Stem(language))
             if positions:
                 index_text = term_generator.index_text
             else:
                 index_text = term_generator.index_text_without_positions
             index_text(normalize(text), weight, prefix.upper())
 
+        return document_id, document
+
+
+_document_builder = None
+
+
+def needs_database(document):
+    """
+    Tells if building the document needs access to the database
+    (i.e. for spelling).
+
+    """
+    default_spelling = document[6]
+    for text in document[3] or ():
+        if isinstance(text, (tuple, list)):
+            spelling = (list(text) + [None] * 6)[4]
+        else:
+            spelling = None
+        if default_spelling if spelling is None else spelling:
+            return True
+    return False
+
+
+def prepare_document(document):
+    """
+    Builds and serialises a document, so it can be prepared in a different
+    process (see Database.index_prepared).
+
+    """
+    global _document_builder
+    if _document_builder is None:
+        _document_builder = DocumentBuilder()
+    document_id, document = _document_builder.build(document)
+    return document_id, document.serialise()
+
+
+class Database(DocumentBuilder):
+    def __init__(self, endpoints, writable, create, data='.', log=logging):
+        super(Database, self).__init__(log=log)
+        self.writable = writable
+        self.create = create
+        self.data = data
+        self.database = _xapian_database(endpoints, writable, create, data=data, log=log)
+
+    def __str__(self):
+        return self.database._db
+
+    def close(self):
+        database = self.database
+        if database._closed:
+            return
+
+        subdatabases = database._subdatabases
+
+        # Could not be opened, try full reopen:
+        endpoints = database._endpoints
+
+        # Remove database from pool
+        _database = subdatabases.pop((self.writable, endpoints), None)
+        assert not _database or _database == database
+        # ...and close.
+        if database:
+            database.close()
+
+        # Subdatabases cleanup:
+        for subdatabase in database._all_databases:
+            subdatabase_number = database._all_databases.index(subdatabase)
+            db, writable, create = database._all_databases_config[subdatabase_number]
+            scheme, hostname, port, username, password, path, query, query_dict = parse_url(db)
+            key = (scheme, hostname, port, username, password, path)
+
+            # Remove subdatabase from pool
+            _subdatabase = subdatabases.pop((writable, key), None)
+            assert not _subdatabase or _subdatabase == subdatabase
+            # ...and close (close on the main database should have already closed it anyway).
+            if subdatabase:
+                subdatabase.close()
+
+        database._closed = True
+        self._term_generators.clear()
+        self.log.debug("Database %s: %s", "closed", database._db)
+
+    def reopen(self, force=False):
+        database = self.database
+        try:
+            if database._closed:
+                raise xapian.DatabaseError("Already closed database")
+            database.reopen()
+
+        except (xapian.NetworkError, xapian.DatabaseError) as exc:
+            # Could not be opened, try full reopen:
+            self.log.error("xapian_reopen database: %s", exc)
+            force = True
+
+        if force:
+            self.close()
+            endpoints = database._endpoints
+            database = _xapian_database(endpoints, self.writable, self.create, data=self.data, log=self.log)
+            self.database = database
+
+        return database
+
+    def index(self, document, commit=False):
+        document_id, document = self.build(document)
+        return self.replace(document_id, document, commit=commit)
+
+    def index_prepared(self, prepared, commit=False):
+        document_id, document = prepared
+        document = xapian.Document.unserialise(document)
         return self.replace(document_id, document, commit=commit)
 
+    def bulk_index(self, documents, commit=False):
+        indexed = 0
+        for document in documents:
+            self.index(document)
+            indexed += 1
+        if commit:
+            self.commit()
+        return indexed
+
     def replace(self, document_id, document, commit=False, _t=0):
         database = self.database
         try:
@@ -665,6 +861,51 @@ class Database(object):
             document_id = prefixed(document_id, DOCUMENT_ID_TERM_PREFIX)
         return self.drop(document_id, commit=commit)
 
+    def delete_query(self, query, limit, max_docid=None, exclude=(), _t=0):
+        """
+        Deletes up to ``limit`` documents matching the query (as returned by
+        the search_parser), in docid order, skipping documents newer than
+        ``max_docid`` and the documents with the id terms (or docids) in
+        ``exclude``. Returns the number of deleted documents (fewer than
+        ``limit`` once there are no more).
+
+        """
+        from .search import Search
+        database = self.database
+        try:
+            excluded = set()
+            for term in exclude:
+                if isinstance(term, basestring):
+                    excluded.update(posting.docid for posting in database.postlist(term))
+                else:
+                    excluded.add(term)
+            xquery = Search(self, query, get_matches=False, get_data=False, data=self.data, log=self.log).query
+            term = _query_term(xquery)
+            if term is not None:
+                # Pure term query, no need to run the match:
+                docids = []
+                for posting in database.postlist(term):
+                    if len(docids) >= limit or max_docid is not None and posting.docid > max_docid:
+                        break
+                    if posting.docid not in excluded:
+                        docids.append(posting.docid)
+            else:
+                enquire = xapian.Enquire(database)
+                enquire.set_query(xquery)
+                enquire.set_weighting_scheme(xapian.BoolWeight())
+                enquire.set_docid_order(xapian.Enquire.ASCENDING)
+                docids = [m.docid for m in enquire.get_mset(0, limit + len(excluded)) if (max_docid is None or m.docid <= max_docid) and m.docid not in excluded][:limit]
+        except (xapian.NetworkError, xapian.DatabaseError) as exc:
+            if _t > 3:
+                raise XapianError(exc)
+            elif _t > 1:
+                gevent.sleep(0.1)
+            self.reopen(_t > 1)
+            return self.delete_query(query, limit, max_docid=max_docid, exclude=exclude, _t=_t + 1)
+        for docid in docids:
+            self.drop(docid)
+        return len(docids)
+
     def drop(self, document_id, commit=False, _t=0):
         database = self.database
         try:
@@ -691,6 +932,24 @@ class Database(object):
             self.reopen(_t > 1)
             return self.commit(_t=_t + 1)
 
+    def begin_transaction(self, flush=True):
+        try:
+            self.database.begin_transaction(flush)
+        except (xapian.NetworkError, xapian.DatabaseError) as exc:
+            raise XapianError(exc)
+
+    def commit_transaction(self):
+        try:
+            self.database.commit_transaction()
+        except (xapian.NetworkError, xapian.DatabaseError) as exc:
+            raise XapianError(exc)
+
+    def cancel_transaction(self):
+        try:
+            self.database.cancel_transaction()
+        except (xapian.NetworkError, xapian.DatabaseError) as exc:
+            raise XapianError(exc)
+
     def get_uuid(self, _t=0):
         database = self.database
         try:
@@ -704,6 +963,20 @@ class Database(object):
             return self.get_uuid(_t=_t + 1)
         return uuid
 
+    def get_revisions(self):
+        """
+        Returns the (uuid, revision) of each of the subdatabases, or None if
+        they can't be told (xapian < 1.4 or backends not supporting it).
+
+        """
+        revisions = []
+        for subdatabase in self.database._all_databases:
+            try:
+                revisions.append((subdatabase.get_uuid(), subdatabase.get_revision()))
+            except (AttributeError, xapian.Error):
+                return None
+        return tuple(revisions)
+
     def get_doccount(self, _t=0):
         database = self.database
         try:
@@ -18,6 +18,13 @@ class NewConnection(ConnectionError):
     pass
 
 
+class BusyError(ServerError):
+    """Raised when the server rejects changes until its queues drain."""
+    def __init__(self, message, retry_after=1):
+        super(BusyError, self).__init__(message)
+        self.retry_after = retry_after
+
+
 class InvalidIndexError(XapianError):
     """Raised when an index can not be opened."""
     pass
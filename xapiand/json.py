@@ -91,6 +91,43 @@ def xapian_decoder(data):
     return data
 
 
+def _simplify_key(key):
+    if isinstance(key, unicode):
+        return key
+    if isinstance(key, bytes):
+        return key.decode('utf-8', 'replace')
+    return unicode(json.dumps(key))  # as JSON object keys
+
+
+def simplify(value):
+    """
+    Returns the value with the types JSON can't represent replaced by the
+    strings dumps would have used for them.
+
+    """
+    if isinstance(value, dict):
+        return dict((_simplify_key(k), simplify(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [simplify(v) for v in value]
+    if value is None or isinstance(value, (unicode, bool, int, long, float)):
+        return value
+    return simplify(XapianJSONEncoder().default(value))
+
+
+def unsimplify(value):
+    """
+    Decodes a simplified value the way loads decodes its JSON (strings
+    with values of the types JSON can't represent are parsed back to them,
+    in the objects).
+
+    """
+    if isinstance(value, dict):
+        return xapian_decoder(dict((k, unsimplify(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return [unsimplify(v) for v in value]
+    return value
+
+
 def dump(obj, fp, **kwargs):
     if 'ensure_ascii' not in kwargs:
         kwargs['ensure_ascii'] = False
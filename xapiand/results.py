@@ -1,3 +1,10 @@
+from __future__ import absolute_import, unicode_literals
+
+# In raw data mode, the (stored) JSON data is appended verbatim as the last
+# field of the JSON results, after this separator:
+RAW_DATA_SEPARATOR = ', "data": '
+
+
 class XapianResult(object):
     pass
 
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals, absolute_import
 
 import base64
+import marshal
 import logging
 
 import xapian
@@ -9,14 +10,43 @@ from . import json
 from .core import get_slot, get_prefix, expand_terms, find_terms, DOCUMENT_CUSTOM_TERM_PREFIX
 from .serialise import normalize, serialise_value
 from .exceptions import XapianError
+from .utils import LRUCache, sizeof, parse_url
 
 MAX_DOCS = 10000
+RAW_DATA_START = (b'{', b'[', b'"')  # data stored as JSON (by index_parser)
+RESULTS_CACHE_SIZE = 64 * 1024 * 1024  # bytes
+QUERIES_CACHE_SIZE = 4 * 1024 * 1024  # bytes
+
+# Xapian >= 1.4 expands wildcards and partials when the query is run,
+# older versions do it when parsing (so parsed queries depend on the terms
+# in the database):
+LAZY_WILDCARDS = hasattr(xapian.Query, 'OP_WILDCARD')
+
+results_cache = LRUCache(RESULTS_CACHE_SIZE)
+queries_cache = LRUCache(QUERIES_CACHE_SIZE)
+
+
+def _canonical(value):
+    """
+    Returns a hashable version of the (parsed) query, independent of the
+    order of the keys.
+
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_canonical(v) for v in value)
+    return value
 
 
 class Search(object):
+    # Network round-trips to the (remote) databases of searches using them:
+    total_searches = 0
+    total_round_trips = 0
+
     def __init__(self, database, search,
                  get_matches=True, get_data=True, get_terms=False, get_size=False,
-                 data='.', log=logging, dead=False):
+                 data='.', log=logging, dead=False, cache=None, raw_data=False):
         self.database = database
         self.search = search
 
@@ -24,6 +54,7 @@ class Search(object):
         self.get_terms = get_terms
         self.get_data = get_data
         self.get_size = get_size
+        self.raw_data = raw_data
 
         self.data = data
         self.log = log
@@ -32,6 +63,7 @@ class Search(object):
         self.spies = {}
         self.warnings = []
         self.produced = 0
+        self.round_trips = 0
 
         self.size = None
         self.facets = self.search.get('facets')
@@ -39,9 +71,75 @@ class Search(object):
         self.maxitems = self.search.get('maxitems', MAX_DOCS)
         self.first = self.search.get('first', 0)
 
-        self.setup()
+        # Results of the same query for the same revisions of the databases
+        # are taken from the cache (setting up the query is also skipped):
+        self.cache = cache
+        self.cache_key = None
+        self.cached = None
+        if cache is not None:
+            self.cache_key = self.get_cache_key()
+            if self.cache_key is not None:
+                self.cached = cache.get(self.cache_key)
+
+        if self.cached is None:
+            self.setup()
+        else:
+            self.query, self.warnings = self.cached[:2]
+
+    def get_cache_key(self):
+        revisions = self.database.get_revisions()
+        if revisions is None:
+            return
+        return (
+            self.database.database._endpoints,
+            revisions,
+            _canonical(self.search),
+            self.get_matches,
+            self.get_data,
+            self.get_terms,
+            self.get_size,
+            self.raw_data,
+        )
+
+    def get_query_key(self):
+        search = self.search.get('search')
+        partials = self.search.get('partials')
+        key = (
+            _canonical(search),
+            _canonical(self.search.get('ranges')),
+            _canonical(partials),
+            _canonical(self.search.get('terms')),
+        )
+        if not LAZY_WILDCARDS and (partials or '*' in ('%s' % (search,)).replace('(*)', '')):
+            revisions = self.database.get_revisions()
+            if revisions is None:
+                return
+            key += (self.database.database._endpoints, revisions)
+        return key
 
     def setup(self):
+        # Query objects can't be shared between threads, so parsed queries
+        # are cached serialised and rebuilt for each search:
+        key = self.get_query_key()
+        serialised = queries_cache.get(key) if key is not None else None
+        if serialised is None:
+            query = self.parse_query()
+            if key is not None:
+                try:
+                    serialised = query.serialise()
+                except xapian.Error:
+                    pass  # Not serialisable, not cached
+                else:
+                    queries_cache.set(key, serialised, sizeof(key) + sizeof(serialised))
+        else:
+            query = xapian.Query.unserialise(serialised)
+
+        self.query = query
+        self.sort_by = self.search.get('sort_by')
+        self.distinct = self.search.get('distinct')
+        self.sort_by_reversed = self.search.get('sort_by_reversed')
+
+    def parse_query(self):
         queryparser = xapian.QueryParser()
         queryparser.set_database(self.database.database)
 
@@ -170,10 +268,7 @@ class Search(object):
             else:
                 query = xapian.Query()
 
-        self.query = query
-        self.sort_by = self.search.get('sort_by')
-        self.distinct = self.search.get('distinct')
-        self.sort_by_reversed = self.search.get('sort_by_reversed')
+        return query
 
     def get_enquire(self):
         enquire = xapian.Enquire(self.database.database)
@@ -232,7 +327,43 @@ class Search(object):
         return enquire
 
     def get_results(self):
+        if self.cached is not None:
+            query, warnings, self.size, self.estimated, self.produced, results = self.cached
+            for result in results:
+                yield marshal.loads(result)
+            return
+
+        if self.cache_key is None:
+            for result in self._get_results():
+                yield result
+            return
+
+        # Results are cached serialised (so changing the ones handed out
+        # doesn't touch the cache), only once they've all been produced and
+        # if they fit in the cache:
+        results = []
+        size = sizeof(results)
+        for result in self._get_results():
+            if results is not None:
+                try:
+                    serialised = marshal.dumps(result)
+                except ValueError:
+                    results = None  # Not serialisable, not cached
+                else:
+                    size += sizeof(serialised)
+                    results.append(serialised)
+                    if size > self.cache.maxbytes:
+                        results = None
+            yield result
+        if results is not None:
+            self.cache.set(self.cache_key, (str(self.query), self.warnings, self.size, self.estimated, self.produced, results), size)
+
+    def is_remote(self):
+        return any(parse_url(db)[0] != 'file' for db in self.database.database._endpoints)
+
+    def _get_results(self):
         doccount = self.database.get_doccount()
+        round_trips = 2  # get_doccount() and get_mset()
 
         maxitems = max(min(self.maxitems, doccount - self.first, MAX_DOCS), 0)
         check_at_least = max(min(self.check_at_least, doccount, MAX_DOCS), 0)
@@ -245,12 +376,24 @@ class Search(object):
             matches = enquire.get_mset(self.first, maxitems, check_at_least)
         except (xapian.NetworkError, xapian.DatabaseError):
             self.database.reopen()
+            round_trips += 2  # reopen() and get_mset()
             try:
                 enquire = self.get_enquire()
                 matches = enquire.get_mset(self.first, maxitems, check_at_least)
             except (xapian.NetworkError, xapian.DatabaseError) as exc:
                 raise XapianError(exc)
 
+        # Prefetch the documents of the whole page at once (remote databases
+        # pipeline the requests, instead of a round-trip per document):
+        prefetched = False
+        if maxitems and matches.size():
+            try:
+                matches.fetch()
+                prefetched = True
+                round_trips += 1
+            except (xapian.NetworkError, xapian.DatabaseError) as exc:
+                self.log.debug("Unable to prefetch documents: %s", exc)
+
         self.produced = 0
         self.estimated = None
         self.size = matches.size()
@@ -275,7 +418,15 @@ class Search(object):
         produced = 0
         for match in matches:
             docid = match.docid
-            document = self.database.get_document(docid)
+            document = None
+            if prefetched:
+                try:
+                    document = match.document
+                except (xapian.NetworkError, xapian.DatabaseError):
+                    pass
+            if document is None:
+                document = self.database.get_document(docid)
+                round_trips += 1
 
             self.dead or 'alive'  # Raises DeadException when needed
             id = self.database.get_value(document, get_slot('ID'))
@@ -292,16 +443,21 @@ class Search(object):
                 data = self.database.get_data(document)
                 if data is None:
                     continue
-                try:
-                    data = json.loads(data)
-                except Exception:
-                    data = base64.b64encode(data)
+                # In raw data mode, the stored JSON is returned as it is:
+                if not self.raw_data or data[:1] not in RAW_DATA_START:
+                    try:
+                        data = json.loads(data)
+                    except Exception:
+                        data = base64.b64encode(data)
+                    if self.raw_data:
+                        data = json.dumps(data)
                 result.update({
                     'data': data,
                 })
             if self.get_terms:
                 terms = []
                 termlist = self.database.get_termlist(document)
+                round_trips += 1
                 for t in termlist:
                     self.dead or 'alive'  # Raises DeadException when needed
                     terms.append(t.term.decode('utf-8'))
@@ -310,6 +466,18 @@ class Search(object):
                 })
             yield result
         self.produced = produced
+        if self.is_remote():
+            self.round_trips = round_trips
+            Search.total_searches += 1
+            Search.total_round_trips += round_trips
+
+    @classmethod
+    def stats(cls):
+        return {
+            'remote_searches': cls.total_searches,
+            'round_trips': cls.total_round_trips,
+            'round_trips_per_search': round(float(cls.total_round_trips) / cls.total_searches, 2) if cls.total_searches else 0,
+        }
 
     @property
     def results(self):
@@ -1,17 +1,23 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 import time
+import marshal
 import logging
 import weakref
 import threading
 from hashlib import md5
 
 from functools import wraps
+from contextlib import contextmanager
 
 from gevent import socket
 from gevent.server import StreamServer
 from gevent.threadpool import ThreadPool
-from ..utils import format_time, sendall, readline
+from .. import json
+from ..utils import format_time, pack_frame, SocketReader, FRAME_MAX_SIZE
+
+OUTPUT_BUFFER_SIZE = 64 * 1024  # bytes of output lines coalesced in a single write
+OUTPUT_BUFFER_LATENCY = 0.05  # seconds output lines can be held in the buffer
 
 
 class QuitCommand(Exception):
@@ -93,7 +99,8 @@ def command(threaded=False, **kwargs):
                 self.client_socket = socket.socket(_sock=client_socket._sock)
 
                 try:
-                    command.executed(func(self, *args, **kwargs))
+                    with self.buffered():
+                        command.executed(func(self, *args, **kwargs))
                 except (IOError, RuntimeError, socket.error) as e:
                     command.error(e)
                 except DeadException:
@@ -109,6 +116,14 @@ def command(threaded=False, **kwargs):
 
 class ClientReceiver(object):
     delimiter = b'\r\n'
+    max_frame_size = FRAME_MAX_SIZE  # of the binary protocol
+
+    # Output counters (for all clients, updated from the threadpool too):
+    output_lock = threading.Lock()
+    output_commands = 0
+    output_lines = 0
+    output_writes = 0
+    output_bytes = 0
 
     def __init__(self, server, client_socket, address, log=logging,
                  encoding='utf-8', encoding_errors='strict'):
@@ -121,6 +136,7 @@ class ClientReceiver(object):
         self.encoding = encoding
         self.encoding_errors = encoding_errors
         self.cmd_id = 0
+        self.binary = False
         self.activity = time.time()
 
         self.client_id = ("Client-%s" % md5('%s:%s' % (address[0], address[1])).hexdigest())
@@ -144,7 +160,21 @@ class ClientReceiver(object):
         self.local.client_socket = value
 
     def handle(self):
-        for line in readline(self.client_socket, encoding=self.encoding, encoding_errors=self.encoding_errors):
+        reader = SocketReader(self.client_socket, encoding=self.encoding, encoding_errors=self.encoding_errors, max_frame_size=self.max_frame_size)
+        while True:
+            if self.binary:
+                try:
+                    line = reader.read_frame()
+                except ValueError as e:
+                    self.sendLine(">> ERR: [413] %s" % e)
+                    break
+                if line is None:
+                    break
+                if not line:
+                    continue  # Empty frames are no-ops
+                line = line.decode(self.encoding, self.encoding_errors)
+            else:
+                line = reader.readline()
             if not line or self.closed:
                 break
             try:
@@ -165,7 +195,8 @@ class ClientReceiver(object):
                 self.log.error("Commands poll is full! (%s/%s)", pool_used, pool_size)
         else:
             try:
-                command.executed(func(line))
+                with self.buffered():
+                    command.executed(func(line))
             except (IOError, RuntimeError, socket.error) as e:
                 command.error(e)
             except DeadException:
@@ -177,11 +208,94 @@ class ClientReceiver(object):
     def connectionLost(self, client):
         pass
 
+    @contextmanager
+    def buffered(self):
+        """
+        Coalesces the lines sent by a command into larger writes. The buffer
+        is flushed when it grows too large, when it's been holding lines for
+        too long (checked as lines are sent), when a final ">>" status line
+        is sent and when the command ends.
+
+        """
+        with ClientReceiver.output_lock:
+            ClientReceiver.output_commands += 1
+        self.local.buffer = []
+        self.local.buffer_size = 0
+        self.local.buffer_time = None
+        try:
+            yield
+        finally:
+            try:
+                self.flush()
+            finally:
+                self.local.buffer = None
+
+    def _write(self, data, final):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            with ClientReceiver.output_lock:
+                ClientReceiver.output_writes += 1
+                ClientReceiver.output_bytes += len(data)
+            self.client_socket.sendall(data)
+            return
+        buf.append(data)
+        self.local.buffer_size += len(data)
+        now = time.time()
+        if self.local.buffer_time is None:
+            self.local.buffer_time = now
+        if final or self.local.buffer_size >= OUTPUT_BUFFER_SIZE or now - self.local.buffer_time >= OUTPUT_BUFFER_LATENCY:
+            self.flush()
+
+    def flush(self):
+        buf = getattr(self.local, 'buffer', None)
+        if buf:
+            data = b''.join(buf)
+            del buf[:]
+            self.local.buffer_size = 0
+            self.local.buffer_time = None
+            with ClientReceiver.output_lock:
+                ClientReceiver.output_writes += 1
+                ClientReceiver.output_bytes += len(data)
+            self.client_socket.sendall(data)
+
     def sendLine(self, line):
-        line += self.delimiter
-        if line[0] not in ("#", " "):
-            line = "%s. %s" % (self.cmd_id, line)
-        sendall(self.client_socket, line, encoding=self.encoding, encoding_errors=self.encoding_errors)
+        with ClientReceiver.output_lock:
+            ClientReceiver.output_lines += 1
+        if self.binary:
+            data = pack_frame(marshal.dumps((self.cmd_id, line)))
+        else:
+            data = line + self.delimiter
+            if data[0] not in ("#", " "):
+                data = "%s. %s" % (self.cmd_id, data)
+            data = data.encode(self.encoding, self.encoding_errors)
+        self._write(data, line.startswith(">>"))
+
+    def sendObject(self, obj):
+        """
+        Sends a result object, as a JSON line (or, in the binary protocol,
+        as a marshalled frame of its simplified form, which clients decode
+        as JSON, so they get the same types in both protocols).
+
+        """
+        if not self.binary:
+            self.sendLine(json.dumps(obj, ensure_ascii=False))
+            return
+        with ClientReceiver.output_lock:
+            ClientReceiver.output_lines += 1
+        data = marshal.dumps((self.cmd_id, json.simplify(obj)))
+        self._write(pack_frame(data), False)
+
+    @classmethod
+    def output_stats(cls):
+        with cls.output_lock:
+            commands, lines, writes, size = cls.output_commands, cls.output_lines, cls.output_writes, cls.output_bytes
+        return {
+            'commands': commands,
+            'lines': lines,
+            'writes': writes,
+            'bytes': size,
+            'writes_per_command': round(float(writes) / commands, 2) if commands else 0,
+        }
 
     def lineReceived(self, line):
         self.activity = time.time()
@@ -283,6 +397,26 @@ class CommandReceiver(ClientReceiver):
         raise QuitCommand
     exit = quit
 
+    @command
+    def protocol(self, line=''):
+        """
+        Sets the protocol of the connection (replying in the current one).
+
+        The text protocol (default) uses lines. In the binary protocol,
+        commands are sent as frames: a 4 bytes (big-endian) length followed
+        by the UTF-8 command line, and replies are frames with a marshalled
+        (command id, line) tuple, or (command id, object) for results.
+
+        Usage: PROTOCOL [TEXT|BINARY]
+
+        """
+        mode = line.strip().upper() or 'TEXT'
+        if mode not in ('TEXT', 'BINARY'):
+            self.sendLine(">> ERR: [400] Invalid protocol: %s" % mode)
+            return
+        self.sendLine(">> OK")
+        self.binary = mode == 'BINARY'
+
     @command(internal=True)
     def weak(self, line=''):
         """
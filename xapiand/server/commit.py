@@ -0,0 +1,194 @@
+from __future__ import unicode_literals, absolute_import
+
+import time
+import logging
+import threading
+
+import gevent
+from gevent.event import AsyncResult
+
+COMMIT_TIMEOUT = 1
+COMMIT_DOCS = 10000
+COMMIT_BYTES = 64 * 1024 * 1024  # 64MB
+
+COMMIT_MAXIMUM_FACTOR = 9.0  # maximum delay, in commit timeouts
+COMMIT_LATENCY_FACTOR = 4.0  # idle time needed, in commit latencies
+COMMIT_LATENCY_WEIGHT = 0.3  # weight of the last commit in the latency average
+
+
+def document_size(cmd, args):
+    """
+    Returns the number of documents and the (roughly) estimated size in
+    bytes for a writer command.
+
+    """
+    if cmd in ('INDEX', 'CINDEX'):
+        documents = (args[0],)
+    elif cmd in ('BINDEX', 'CBINDEX'):
+        documents = args[0]
+    elif cmd == 'PINDEX':
+        return 1, len(args[0][1])
+    elif cmd in ('DELETE', 'CDELETE'):
+        return 1, 64
+    else:
+        return 0, 0
+    size = 0
+    for document in documents:
+        document_id, document_values, document_terms, document_texts, document_data = document[:5]
+        size += len(document_data or '')
+        size += 32 * (len(document_values or ()) + len(document_terms or ()))
+        size += sum(len(text[0] if isinstance(text, (tuple, list)) else text or '') for text in document_texts or ())
+    return len(documents), size
+
+
+def queued_weight(msg):
+    """
+    Returns what a queued writer message counts for the queue water marks:
+    the number of documents for bulk commands (BINDEX), one otherwise.
+
+    """
+    try:
+        cmd, endpoints, args = msg[:3]
+        if cmd in ('BINDEX', 'CBINDEX'):
+            return max(len(args[0]), 1)
+    except (TypeError, ValueError, IndexError):
+        pass
+    return 1
+
+
+class CommitScheduler(object):
+    """
+    Decides when a writer should commit.
+
+    Keeps track of the pending documents, their estimated size and the time
+    changes have been waiting, as well as the latency of recent commits, and
+    commits when any of the configured budgets is exceeded:
+
+        * documents: ``max_docs`` documents are pending.
+        * bytes: ``max_bytes`` bytes are pending.
+        * maximum: changes have been waiting for ``maximum`` seconds.
+        * idle: no changes arrived for ``timeout`` seconds (or for a few
+          commit latencies, if commits are slow).
+        * requested: a commit was explicitly requested (several requests
+          arriving while the commit is still pending are coalesced).
+
+    """
+    def __init__(self, timeout=COMMIT_TIMEOUT, maximum=None, max_docs=COMMIT_DOCS, max_bytes=COMMIT_BYTES, log=logging):
+        self.timeout = timeout
+        self.maximum = timeout * COMMIT_MAXIMUM_FACTOR if maximum is None else maximum
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.log = log
+
+        self.latency = 0.0
+        self.commits = 0
+        self.requests = 0
+        self.coalesced = 0
+        self.reset()
+
+    def reset(self):
+        self.pending_docs = 0
+        self.pending_bytes = 0
+        self.first = None
+        self.last = None
+        self.requested = False
+
+    @property
+    def pending(self):
+        return self.first is not None
+
+    def add(self, docs, size):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.pending_docs += docs
+        self.pending_bytes += size
+
+    def request(self):
+        if not self.pending:
+            return  # Nothing to commit
+        self.requests += 1
+        if self.requested:
+            self.coalesced += 1
+        self.requested = True
+
+    def due(self, now=None):
+        """
+        Returns the reason for a commit to be done now (or None).
+
+        """
+        if not self.pending:
+            return
+        if self.requested:
+            return 'requested'
+        if now is None:
+            now = time.time()
+        if now - self.first >= self.maximum:
+            return 'maximum'
+        if self.max_docs and self.pending_docs >= self.max_docs:
+            return 'documents'
+        if self.max_bytes and self.pending_bytes >= self.max_bytes:
+            return 'bytes'
+        if now - self.last >= max(self.timeout, self.latency * COMMIT_LATENCY_FACTOR):
+            return 'idle'
+
+    def committed(self, duration):
+        if self.commits:
+            self.latency += (duration - self.latency) * COMMIT_LATENCY_WEIGHT
+        else:
+            self.latency = duration
+        self.commits += 1
+        self.reset()
+
+    def stats(self):
+        return {
+            'pending_docs': self.pending_docs,
+            'pending_bytes': self.pending_bytes,
+            'commits': self.commits,
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'latency': self.latency,
+        }
+
+
+class CommitTicket(object):
+    """
+    Lets a client wait for its changes to be committed by one or more
+    writers.
+
+    Tickets are created (and waited) in the hub, writer threads wake it up
+    through an async watcher, so waiting doesn't hold a thread.
+
+    """
+    def __init__(self, id, count=1):
+        self.id = id
+        self.count = count
+        self.errors = []
+        self.lock = threading.Lock()
+        self.result = AsyncResult()
+        loop = gevent.get_hub().loop
+        async_watcher = getattr(loop, 'async_', None) or getattr(loop, 'async')
+        self.watcher = async_watcher()
+        self.watcher.start(self.result.set, True)
+
+    def done(self, error=None):
+        """
+        Marks one of the writers as done, returns True when all are.
+        Can be called from any thread.
+
+        """
+        with self.lock:
+            if error is not None:
+                self.errors.append(error)
+            self.count -= 1
+            if self.count > 0:
+                return False
+        self.watcher.send()
+        return True
+
+    def wait(self, timeout=None):
+        try:
+            return self.result.wait(timeout) is True
+        finally:
+            self.watcher.stop()
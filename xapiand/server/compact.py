@@ -0,0 +1,352 @@
+from __future__ import unicode_literals, absolute_import, print_function
+
+import os
+import sys
+import time
+import shutil
+import pickle
+import logging
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+from ..utils import format_time
+
+COMPACT_NICE = 10  # niceness of the compaction processes (19 also makes them use idle I/O)
+COMPACT_RETRIES = 3  # compactions restarted when the revision compacted is discarded by the writer
+
+COMPACTED_SUFFIX = '.compacted'
+REPLAY_SUFFIX = '.replay'
+REVISION_MARKER = 'REVISION'  # recorded (as a command) after each commit while compacting
+OLD_SUFFIX = '.old'
+LINK_SUFFIX = '.link'
+VERSION_SUFFIX = '.v'
+DATABASE_FILES = ('iamglass', 'iamchert', 'iambrass', 'iamflint')
+
+
+def compact(sources, destination, renumber=False):
+    """
+    Compacts (merges) the source databases into the destination directory.
+    Sources are paths or, with xapian >= 1.4, opened databases (so the
+    revision they were opened at is the one compacted).
+
+    """
+    import xapian
+
+    if hasattr(xapian.Database, 'compact'):
+        database = xapian.Database()
+        for source in sources:
+            database.add_database(source if isinstance(source, xapian.Database) else xapian.Database(source))
+        database.compact(destination, 0 if renumber else xapian.DBCOMPACT_NO_RENUMBER)
+    else:
+        compactor = xapian.Compactor()
+        compactor.set_renumber(renumber)
+        for source in sources:
+            compactor.add_source(source)
+        compactor.set_destdir(destination)
+        compactor.compact()
+
+
+def nice_command(args, nice=COMPACT_NICE):
+    """
+    Returns the command line to run a command with the given niceness
+    (CPU and, if ionice is available, I/O priority).
+
+    """
+    if nice <= 0:
+        return args
+    command = []
+    ionice = find_executable('ionice')
+    if ionice:
+        if nice >= 19:
+            command.extend([ionice, '-c', '3'])
+        else:
+            command.extend([ionice, '-c', '2', '-n', '%d' % min(nice * 8 // 19, 7)])
+    command.extend([find_executable('nice') or 'nice', '-n', '%d' % nice])
+    return command + args
+
+
+def directory_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return size
+
+
+def versions(path):
+    """
+    Returns the versions of the database at path (compacted directories
+    named ``<path>.v<version>``) as a dict of version: directory.
+
+    """
+    directory, name = os.path.split(path)
+    prefix = name + VERSION_SUFFIX
+    found = {}
+    try:
+        fnames = os.listdir(directory or '.')
+    except OSError:
+        return found
+    for fname in fnames:
+        if fname.startswith(prefix) and fname[len(prefix):].isdigit():
+            found[int(fname[len(prefix):])] = os.path.join(directory, fname)
+    return found
+
+
+def recover(path, log=logging):
+    """
+    Cleans up what a compaction of the database at path interrupted (by a
+    crash) left behind, restoring the original database if it was moved
+    aside while being swapped.
+
+    """
+    old = path + OLD_SUFFIX
+    link = path + LINK_SUFFIX
+    swapping = os.path.islink(link)
+    if swapping and not os.path.islink(path) and os.path.isdir(old):
+        log.warning("Restoring database interrupted while being swapped: %s", path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)  # Created empty (by a reader) while moved aside
+        os.rename(old, path)
+    leftovers = [path + COMPACTED_SUFFIX, path + REPLAY_SUFFIX] if os.path.lexists(path) else []
+    if swapping or os.path.islink(path):
+        current = os.path.realpath(path)
+        leftovers.extend([old, link])
+        leftovers.extend(d for d in versions(path).values() if os.path.realpath(d) != current)
+    for leftover in leftovers:
+        if os.path.islink(leftover):
+            os.unlink(leftover)
+        elif os.path.isfile(leftover):
+            os.unlink(leftover)
+        elif os.path.isdir(leftover):
+            log.warning("Removing leftovers of an interrupted compaction: %s", leftover)
+            shutil.rmtree(leftover, ignore_errors=True)
+
+
+def recover_all(directory, log=logging):
+    """
+    Cleans up after the interrupted compactions of the databases found in
+    directory (see ``recover()``).
+
+    """
+    suffixes = (COMPACTED_SUFFIX, REPLAY_SUFFIX, OLD_SUFFIX, LINK_SUFFIX)
+    for dirpath, dirnames, filenames in os.walk(directory):
+        paths = set()
+        for fname in dirnames + filenames:
+            name, dot, version = fname.rpartition(VERSION_SUFFIX)
+            if name and version.isdigit():
+                paths.add(name)
+            for suffix in suffixes:
+                if fname.endswith(suffix):
+                    paths.add(fname[:-len(suffix)])
+        for name in paths:
+            recover(os.path.join(dirpath, name), log=log)
+        # Databases don't have databases inside:
+        dirnames[:] = [d for d in dirnames if not any(os.path.exists(os.path.join(dirpath, d, f)) for f in DATABASE_FILES)]
+
+
+class Compaction(object):
+    """
+    Compacts a local database into a sibling directory, in a low priority
+    process waited by a background thread, while the database keeps being
+    written (and committed). The process compacts the last committed
+    revision, read from a database opened read-only, and tells which one
+    it was. The commands applied to the database meanwhile are recorded,
+    along with the revisions committed, so those after the compacted
+    revision can be replayed into the compacted copy before it's swapped
+    for the original one.
+
+    Compacted databases are kept in versioned directories (``<path>.v1``,
+    ``<path>.v2``...) with the database path being a symlink to the current
+    one, so swapping is an atomic rename of the symlink.
+
+    """
+    def __init__(self, path, revision, nice=COMPACT_NICE, callback=None, log=logging):
+        self.path = path
+        self.target = path + COMPACTED_SUFFIX
+        self.replay_log = path + REPLAY_SUFFIX
+        self.nice = nice
+        self.callback = callback
+        self.log = log
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.thread = None
+        self.recorder = None
+        self.recorded = 0
+        self.committed_revision = None
+        self.revision = None  # Compacted revision
+        self.committed(revision)
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def start(self):
+        """
+        Starts compacting the database in the background. The revision
+        given is the one last committed, the revisions committed after it
+        must be told (see ``committed()``).
+
+        """
+        self.started = time.time()
+        if os.path.exists(self.target):
+            shutil.rmtree(self.target)
+        self.thread = threading.Thread(target=self.run, name='Compactor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            args = nice_command([sys.executable, '-m', __name__, self.path, self.target], self.nice)
+            env = dict(os.environ)
+            root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            output = process.communicate()[0]
+            if process.returncode:
+                raise RuntimeError("Compaction failed (%s): %s" % (process.returncode, output.strip()))
+            for line in output.splitlines():
+                if line.startswith(REVISION_MARKER):
+                    self.revision = int(line.split()[1])  # The last one is the one compacted
+            if self.revision is None:
+                raise RuntimeError("Compaction failed: revision compacted unknown")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = time.time()
+            if self.callback:
+                self.callback()
+
+    def _record(self, command):
+        if self.recorder is None:
+            self.recorder = open(self.replay_log, 'wb')
+        pickle.dump(command, self.recorder, pickle.HIGHEST_PROTOCOL)
+
+    def committed(self, revision):
+        """
+        Records the revision committed last (after the commands in it).
+
+        """
+        if revision != self.committed_revision:
+            self._record((REVISION_MARKER, (revision,)))
+            self.committed_revision = revision
+
+    def record(self, commands):
+        """
+        Records commands (as ``(cmd, args)``) applied to the database while
+        compacting.
+
+        """
+        for command in commands:
+            self._record(command)
+        self.recorded += len(commands)
+
+    def replay(self):
+        """
+        Yields the recorded commands not in the compacted revision, in the
+        order they were applied: those after the last commit recorded up to
+        it (revisions committed by xapian itself, when flushing, aren't
+        recorded, and so the commands in them since the last recorded commit
+        are replayed again, which leaves the database the same).
+
+        """
+        self.recorder.close()
+        with open(self.replay_log, 'rb') as f:
+            start = None
+            while True:
+                try:
+                    cmd, args = pickle.load(f)
+                except EOFError:
+                    break
+                if cmd == REVISION_MARKER:
+                    if args[0] > self.revision:
+                        break
+                    start = f.tell()
+            if start is None:
+                raise RuntimeError("Compacted revision %s is older than the compaction" % self.revision)
+            f.seek(start)
+            while True:
+                try:
+                    cmd, args = pickle.load(f)
+                except EOFError:
+                    break
+                if cmd != REVISION_MARKER:
+                    yield cmd, args
+
+    def discard(self):
+        """
+        Removes the compacted copy and the recorded commands.
+
+        """
+        if self.recorder is not None:
+            self.recorder.close()
+        if os.path.exists(self.replay_log):
+            os.unlink(self.replay_log)
+        if os.path.exists(self.target):
+            shutil.rmtree(self.target, ignore_errors=True)
+
+    def swap(self):
+        """
+        Replaces the database with the compacted one (the recorded commands
+        must have been replayed into it). Nothing must be using the database
+        (writable) while swapping.
+
+        """
+        if self.error:
+            self.discard()
+            raise self.error
+        size = directory_size(self.path)
+        current = os.path.realpath(self.path)
+        versioned = '%s%s%d' % (self.path, VERSION_SUFFIX, max(versions(self.path) or [0]) + 1)
+        link = self.path + LINK_SUFFIX
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.basename(versioned), link)
+        os.rename(self.target, versioned)
+        if not os.path.islink(self.path):
+            # The first time, the database directory must be moved aside
+            # (not atomically) for the symlink to take its place:
+            current = self.path + OLD_SUFFIX
+            if os.path.exists(current):
+                shutil.rmtree(current)
+            os.rename(self.path, current)
+        try:
+            os.rename(link, self.path)
+        except OSError:
+            if os.path.islink(self.path) or not os.path.isdir(self.path):
+                raise
+            # Created empty (by a reader) while the original was moved aside
+            shutil.rmtree(self.path)
+            os.rename(link, self.path)
+        shutil.rmtree(current, ignore_errors=True)
+        self.discard()
+        self.log.info("Compacted %s from %s to %s bytes (%d commands replayed) ~ compacting took %s", self.path, size, directory_size(self.path), self.recorded, format_time(self.finished - self.started))
+
+
+def main():
+    import xapian
+
+    source, destination = sys.argv[1:3]
+    if not hasattr(xapian.Database, 'compact'):
+        sys.exit("Compacting databases being written needs xapian >= 1.4")
+    for retry in range(COMPACT_RETRIES):
+        # Opened read-only, the last committed revision is the one compacted
+        # (unless the writer commits too much meanwhile, and discards it):
+        database = xapian.Database(source)
+        print("%s %d" % (REVISION_MARKER, database.get_revision()))
+        sys.stdout.flush()
+        try:
+            compact([database], destination)
+            return
+        except xapian.DatabaseModifiedError:
+            database.close()
+            shutil.rmtree(destination, ignore_errors=True)
+    sys.exit("Database modified too much while compacting it: %s" % source)
+
+
+if __name__ == '__main__':
+    main()
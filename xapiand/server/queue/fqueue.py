@@ -4,11 +4,17 @@ import os
 import time
 import zlib
 
+import mmap
 import fcntl
+import struct
 import marshal
+import threading
 import multiprocessing
 from contextlib import contextmanager
 
+import gevent
+from gevent.event import AsyncResult
+
 try:
     import cPickle as pickle
 except ImportError:
@@ -16,6 +22,34 @@ except ImportError:
 
 import logging
 
+# Segment files start with a fixed header (magic and version), followed by
+# blocks; each block holds a batch of records (as written by a single put
+# or a group of puts), optionally compressed as a whole:
+#
+#   header: magic, version
+#   block:  payload length, payload crc32, number of records, flags, payload
+#   record: data length, data crc32, data (pickled value)
+#
+# The read position is kept in a small fixed-size (mmapped) position file,
+# along with the number of records written and read (up to the position).
+#
+# Queues in the previous format (a marshalled position and segments of
+# marshalled, compressed records) are migrated when opened.
+
+MAGIC = b'XQS\x00'
+VERSION = 1
+HEADER = struct.Struct(b'<4sI')
+BLOCK = struct.Struct(b'<IIIB')
+RECORD = struct.Struct(b'<II')
+POSITION = struct.Struct(b'<QQQQ')  # read segment, read offset, read index, write segment
+COUNTS = struct.Struct(b'<QQ')  # records written, records read (follows the position)
+
+COMPRESSED = 0x01
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
 
 @contextmanager
 def flock(fd):
@@ -31,9 +65,10 @@ class FileQueue(object):
 
     STOPPED = False
 
-    shm_size = len(marshal.dumps((0, 0, 0)))
     bucket_size = 10 * 1024 * 1024  # 10MB
     sync_age = 500
+    group_window = 0.0002  # seconds puts wait for others to share a write (None to write each one)
+    compress_size = 1024  # compress blocks of at least this size (None to never compress)
 
     def __init__(self, name=None, log=logging):
         self.name = name
@@ -44,139 +79,409 @@ class FileQueue(object):
         self.spos = None
 
         fnamepos = '%s.pos' % self.name
-        if not os.path.exists(fnamepos):
-            with open(fnamepos, 'wb') as f:  # touch file
-                marshal.dump((0, 0, 0), f)
+        possize = os.path.getsize(fnamepos) if os.path.exists(fnamepos) else None
+        migrate = possize not in (None, POSITION.size, POSITION.size + COUNTS.size)
+        if migrate:
+            old = self._move_old(fnamepos)
+            fnamepos += '.tmp'  # Replaces the old pos file once migrated
+        if migrate or possize is None:
+            with open(fnamepos, 'wb') as f:  # new pos file
+                f.write(POSITION.pack(0, 0, 0, 0) + COUNTS.pack(0, 0))
+        elif possize == POSITION.size:
+            with open(fnamepos, 'ab') as f:  # pos file without the counts
+                f.write(COUNTS.pack(0, 0))
 
         self.fpos = open(fnamepos, 'r+b')
+        self.pos_lock = threading.Lock()
+        self.mpos = mmap.mmap(self.fpos.fileno(), POSITION.size + COUNTS.size)
 
         self.fread = None
+        self.mread = None
         self.frnum = None
+        self.block = None
 
         self.fwrite = None
         self.fwnum = None
 
-        frnum, _ = self._update_pos()
-        self._writing(frnum)
+        self._records = []
+        self._written = AsyncResult()
+        self._writer = None
+
+        if migrate:
+            self._migrate(*old)
+            os.rename(fnamepos, '%s.pos' % self.name)
 
-    def _update_pos(self, fnum=None, offset=None):
-        with flock(self.fpos) as fpos:
-            fpos.seek(0)
+        frnum, _, _, fwnum = self._load_pos()
+        self._open_writing(max(frnum, fwnum))
+        self._cleanup_stale(frnum)
+        if possize == POSITION.size:
+            self._add_written(self._count())
+
+    def _segment(self, fnum):
+        return '%s.%s' % (self.name, fnum)
+
+    def _segments(self, suffix=''):
+        """
+        Returns the (sorted) numbers of the existing segment files.
+
+        """
+        directory, prefix = os.path.split(self.name)
+        prefix += '.'
+        fnums = []
+        for fname in os.listdir(directory or '.'):
+            if fname.startswith(prefix) and fname.endswith(suffix):
+                fnum = fname[len(prefix):len(fname) - len(suffix)]
+                if fnum.isdigit():
+                    fnums.append(int(fnum))
+        return sorted(fnums)
+
+    def _move_old(self, fnamepos):
+        """
+        Moves the segments of a queue in the old format out of the way
+        (segments written by an interrupted migration are discarded).
+        Returns the old read position.
+
+        """
+        with open(fnamepos, 'rb') as f:
             try:
-                _fnum, _offset = marshal.load(fpos)
+                frnum, offset = marshal.load(f)
             except (EOFError, ValueError, TypeError):
-                _fnum, _offset = 0, 0  # New, perhaps empty or corrupt pos file
-            finally:
-                if fnum is not None and offset is not None:
-                    fpos.seek(0)
-                    marshal.dump((fnum, offset), fpos)
-                    fpos.flush()
-                    os.fsync(fpos.fileno())
-        return _fnum, _offset
+                frnum, offset = 0, 0  # Empty or corrupt pos file
+        for fnum in self._segments():
+            fname = self._segment(fnum)
+            with open(fname, 'rb') as f:
+                magic = f.read(HEADER.size)
+            if len(magic) == HEADER.size and HEADER.unpack(magic) == (MAGIC, VERSION):
+                os.unlink(fname)
+            elif fnum < frnum:
+                os.unlink(fname)  # Already read
+            else:
+                os.rename(fname, fname + '.old')
+        return frnum, offset
+
+    def _migrate(self, frnum, offset):
+        """
+        Copies the unread records of the old format segments (moved aside
+        by _move_old) to new segments.
+
+        """
+        fnums = [fnum for fnum in self._segments('.old') if fnum >= frnum]
+        self.log.warning("Migrating queue from the old format: %s", self.name)
+        self._writing(0)
+        migrated = 0
+        for fnum in fnums:
+            fname = self._segment(fnum) + '.old'
+            records = []
+            with open(fname, 'rb') as f:
+                f.seek(offset if fnum == frnum else 0)
+                while True:
+                    try:
+                        checksum, value = marshal.load(f)
+                        if checksum != zlib.crc32(value):
+                            raise ValueError
+                        data = zlib.decompress(value)
+                    except EOFError:
+                        break
+                    except (ValueError, TypeError, zlib.error):
+                        self.log.error("Corrupt old queue segment, skipping the rest of it: %s", fname)
+                        break
+                    records.append(RECORD.pack(len(data), crc32(data)) + data)
+                    if len(records) >= 1000:
+                        self._write(records)
+                        migrated += len(records)
+                        records = []
+            if records:
+                self._write(records)
+                migrated += len(records)
+        self.log.warning("Migrated %d queued records: %s", migrated, self.name)
+
+    def _load_pos(self):
+        with self.pos_lock, flock(self.fpos):
+            return POSITION.unpack_from(self.mpos)
+
+    def _load_counts(self):
+        with self.pos_lock, flock(self.fpos):
+            return COUNTS.unpack_from(self.mpos, POSITION.size)
+
+    def _update_pos(self, frnum=None, offset=None, index=None, fwnum=None, read=None):
+        with self.pos_lock, flock(self.fpos):
+            _frnum, _offset, _index, _fwnum = POSITION.unpack_from(self.mpos)
+            written, _read = COUNTS.unpack_from(self.mpos, POSITION.size)
+            if frnum is not None:
+                _frnum, _offset, _index = frnum, offset, index
+            if fwnum is not None:
+                _fwnum = fwnum
+            if read is not None:
+                _read = read
+            POSITION.pack_into(self.mpos, 0, _frnum, _offset, _index, _fwnum)
+            COUNTS.pack_into(self.mpos, POSITION.size, written, _read)
+            self.mpos.flush()
+
+    def _add_written(self, count):
+        with self.pos_lock, flock(self.fpos):
+            written, read = COUNTS.unpack_from(self.mpos, POSITION.size)
+            COUNTS.pack_into(self.mpos, POSITION.size, written + count, read)
+            self.mpos.flush()
+
+    def _write_segment(self):
+        return POSITION.unpack_from(self.mpos)[3]
 
     def _cleanup(self, fnum):
         """
-        Deletes all files for the queue up to, and including, fnum.
+        Deletes the (already read) segment fnum.
+
+        """
+        try:
+            os.unlink(self._segment(fnum))
+        except OSError:
+            pass
 
+    def _cleanup_stale(self, frnum):
         """
-        while os.path.exists('%s.%s' % (self.name, fnum)):
+        Deletes segments left behind (by a crash) before the read segment,
+        and old format segments left behind by an interrupted migration.
+
+        """
+        for fnum in self._segments():
+            if fnum < frnum:
+                self._cleanup(fnum)
+        for fnum in self._segments('.old'):
             try:
-                fname = '%s.%s' % (self.name, fnum)
-                os.unlink(fname)
-                # self.log.debug("Cleaned up file: %s", fname)
-            except Exception:
+                os.unlink(self._segment(fnum) + '.old')
+            except OSError:
                 pass
-            fnum -= 1
 
-    def _reading(self, frnum):
-        if self.frnum == frnum:
-            return
-        if self.fread:
-            self.fread.close()
-        fname = '%s.%s' % (self.name, frnum)
-        if not os.path.exists(fname):
-            open(fname, 'wb').close()  # touch file
-        self.fread = open(fname, 'rb')
-        self.frnum = frnum
-        # self.log.debug("New read bucket: %s", self.frnum)
+    def _recover(self, fname):
+        """
+        Truncates any torn write at the end of a segment (after a crash).
+        Returns False if the file is not a valid segment.
+
+        """
+        with open(fname, 'r+b') as f:
+            data = f.read()
+            if len(data) < HEADER.size:
+                f.seek(0)
+                f.truncate()
+                f.write(HEADER.pack(MAGIC, VERSION))
+                f.flush()
+                os.fsync(f.fileno())
+                return True
+            magic, version = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                return False
+            offset = HEADER.size
+            while offset + BLOCK.size <= len(data):
+                length, checksum, count, flags = BLOCK.unpack_from(data, offset)
+                end = offset + BLOCK.size + length
+                if end > len(data) or crc32(data[offset + BLOCK.size:end]) != checksum:
+                    break
+                offset = end
+            if offset < len(data):
+                self.log.warning("Truncating %d bytes of incomplete writes: %s", len(data) - offset, fname)
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        return True
+
+    def _open_writing(self, fwnum):
+        fname = self._segment(fwnum)
+        if os.path.exists(fname) and not self._recover(fname):
+            raise IOError("Invalid queue segment: %s" % fname)
+        self._writing(fwnum)
 
     def _writing(self, fwnum):
-        _fwnum = fwnum
-        while os.path.exists('%s.%s' % (self.name, _fwnum)):
-            fwnum = _fwnum
-            _fwnum += 1
+        """
+        Opens segment fwnum for writing (creating it if needed). Refuses
+        to append to existing files without a valid segment header.
+
+        """
         if self.fwnum == fwnum:
             return
+        fname = self._segment(fwnum)
+        fwrite = open(fname, 'a+b')
+        fwrite.seek(0, os.SEEK_END)
+        if fwrite.tell():
+            fwrite.seek(0)
+            magic = fwrite.read(HEADER.size)
+            if len(magic) != HEADER.size or HEADER.unpack(magic) != (MAGIC, VERSION):
+                fwrite.close()
+                raise IOError("Invalid queue segment: %s" % fname)
+            fwrite.seek(0, os.SEEK_END)
+        else:
+            fwrite.write(HEADER.pack(MAGIC, VERSION))
+            fwrite.flush()
+            os.fsync(fwrite.fileno())
         if self.fwrite:
             self.fwrite.close()
-        self.fwrite = open('%s.%s' % (self.name, fwnum), 'ab')
+        self.fwrite = fwrite
         self.fwnum = fwnum
+        if self._write_segment() != fwnum:
+            self._update_pos(fwnum=fwnum)
         # self.log.debug("New write bucket: %s", self.fwnum)
 
+    def _reading(self, frnum):
+        if self.frnum == frnum:
+            return
+        if self.mread:
+            self.mread.close()
+            self.mread = None
+        if self.fread:
+            self.fread.close()
+            self.fread = None
+        self.block = None
+        self.frnum = frnum
+        try:
+            self.fread = open(self._segment(frnum), 'rb')
+        except IOError:
+            pass
+        # self.log.debug("New read bucket: %s", self.frnum)
+
+    def _map(self, size):
+        """
+        Makes sure the mapped segment is at least size bytes long (if the
+        file already is). Returns False otherwise.
+
+        """
+        if self.mread is not None and len(self.mread) >= size:
+            return True
+        if self.fread is None:
+            return False
+        fsize = os.fstat(self.fread.fileno()).st_size
+        if fsize < size:
+            return False
+        if self.mread is not None:
+            self.mread.close()
+        self.mread = mmap.mmap(self.fread.fileno(), fsize, access=mmap.ACCESS_READ)
+        return True
+
     def __del__(self):
+        self.mpos.close()
         self.fpos.close()
         if self.fwrite:
             self.fwrite.close()
+        if self.mread:
+            self.mread.close()
         if self.fread:
             self.fread.close()
 
-    def peek(self):
-        try:
-            crc32, value = marshal.load(self.fread)
-            if crc32 != zlib.crc32(value):
-                raise ValueError
-            return value
-        except EOFError:
-            return None  # The file could not be read, ignore
-        except (ValueError, TypeError):
-            # New, or perhaps empty/corrupt pos file (since the position offset has an invalid marshal)
+    def peek(self, offset):
+        """
+        Returns the records and the end offset of the block at offset of the
+        current read segment, None if there's no (complete) block there (yet)
+        or False if it's corrupt.
+
+        """
+        if self.block and self.block[0] == offset:
+            return self.block[1:]
+        if not self._map(HEADER.size):
+            return None
+        magic, version = HEADER.unpack_from(self.mread)
+        if magic != MAGIC or version != VERSION:
             return False
+        if not self._map(offset + BLOCK.size):
+            return None
+        length, checksum, count, flags = BLOCK.unpack_from(self.mread, offset)
+        start = offset + BLOCK.size
+        end = start + length
+        if not self._map(end):
+            return None
+        payload = self.mread[start:end]
+        if crc32(payload) != checksum:
+            return False
+        if flags & COMPRESSED:
+            payload = zlib.decompress(payload)
+        records = []
+        pos = 0
+        for i in range(count):
+            size, checksum = RECORD.unpack_from(payload, pos)
+            pos += RECORD.size
+            data = payload[pos:pos + size]
+            if len(data) != size or crc32(data) != checksum:
+                return False
+            records.append(data)
+            pos += size
+        self.block = (offset, records, end)
+        return records, end
+
+    def _read(self, frnum, offset, index):
+        """
+        Reads the record at the given position, returns it (or None) and
+        the position of the next one.
+
+        """
+        while True:
+            self._reading(frnum)
+            offset = max(offset, HEADER.size)
+            # The write segment is read before peeking, so the blocks
+            # written before the writer switched segments are all seen:
+            fwnum = self._write_segment()
+            block = self.peek(offset)
+            if block:
+                records, end = block
+                if index < len(records):
+                    value = records[index]
+                    index += 1
+                    if index >= len(records):
+                        offset, index = end, 0
+                    return value, frnum, offset, index
+                offset, index = end, 0
+                continue
+            if frnum >= fwnum:
+                return None, frnum, offset, index  # Nothing more to read (yet)
+            if block is None and self.peek(offset):
+                continue  # Not finished after all
+            if block is False:
+                self.log.error("Corrupt queue segment, skipping the rest of it: %s", self._segment(frnum))
+            # Segment finished, switch to the next one:
+            self._update_pos(frnum + 1, HEADER.size, 0)
+            self._cleanup(frnum)
+            frnum, offset, index = frnum + 1, HEADER.size, 0
+
+    def _more(self, frnum, offset, index):
+        if self.block and self.block[0] == offset and index < len(self.block[1]):
+            return True
+        return self._map(offset + 1) or frnum < self._write_segment()
 
     def get(self, block=True, timeout=None):
         start = time.time()
         value = None
         timeout = timeout or 0 if block else 0
-        while not value and not self.STOPPED:
+        while value is None and not self.STOPPED:
             # Try acquiring the semaphore (in case there's something to read)
             self.sem.acquire(block, timeout)
             if not self.lock.acquire(True, 5):
                 raise RuntimeError("Could not lock queue")
             try:
-                # Get nest file/offset (from shared memory):
+                # Get next segment/offset/index (from shared memory):
                 try:
-                    frnum, offset, sync_age, sync_time = self.spos
+                    frnum, offset, index, read, sync_age, sync_time = self.spos
                 except (ValueError, TypeError):
-                    # New, perhaps empty or corrupt pos file
-                    frnum, offset = self._update_pos()
+                    # New, get it from the pos file
+                    frnum, offset, index, _ = self._load_pos()
+                    read = self._load_counts()[1]
                     sync_time = start
                     sync_age = 0
-                # self.log.debug('%s @ %s' % (self.name, repr((frnum, offset, sync_age))))
-
-                # Open proper queue file for reading (if it isn't open yet):
-                self._reading(frnum)
-                self.fread.seek(offset)
+                # self.log.debug('%s @ %s' % (self.name, repr((frnum, offset, index, sync_age))))
 
                 # Read from the queue
-                value = self.peek()
-                if value:
+                _frnum = frnum
+                value, frnum, offset, index = self._read(frnum, offset, index)
+                if value is not None:
+                    read += 1
                     sync_age += 1
-                    offset = self.fread.tell()
-                    if offset > self.bucket_size:
-                        self._reading(frnum + 1)
-                        self._cleanup(frnum)
-                        sync_age = self.sync_age  # Force updateing position
-                        offset = 0
-                elif value is False:
-                    frnum, offset = self._update_pos()
-                    sync_time = start
-                    sync_age = 0
 
-                # Update position
-                if sync_age >= self.sync_age or sync_age and start - sync_time > 10 or self.STOPPED:
-                    self._update_pos(self.frnum, offset)
+                # Update position (always after switching segments, as the
+                # position was updated then but the read count wasn't)
+                if frnum != _frnum or sync_age >= self.sync_age or sync_age and start - sync_time > 10 or self.STOPPED:
+                    self._update_pos(frnum, offset, index, read=read)
                     sync_time = start
                     sync_age = 0
-                self.spos = (self.frnum, offset, sync_age, sync_time)
+                self.spos = (frnum, offset, index, read, sync_age, sync_time)
+
+                if value is not None and self._more(frnum, offset, index):
+                    # If there's something more to read in the queue,
+                    # release (or re-release) the semaphore.
+                    self.sem.release()
 
             finally:
                 self.lock.release()
@@ -184,22 +489,118 @@ class FileQueue(object):
             if time.time() - start > timeout:
                 break
 
-        if value:
-            if self.peek():
-                # If there's something more to read in the file,
-                # release (or re-release) the semaphore.
-                self.sem.release()
-            return pickle.loads(zlib.decompress(value))
+        if value is not None:
+            return pickle.loads(value)
 
-    def put(self, value, block=True, timeout=None):
-        value = zlib.compress(pickle.dumps(value))
-        crc32 = zlib.crc32(value)
+    def qsize(self):
+        """
+        Returns the number of records waiting to be read (from the counts
+        kept in the pos file).
+
+        """
+        written, read = self._load_counts()
+        if self.spos:
+            read = self.spos[3]
+        return max(written - read, 0)
+
+    def _count(self):
+        """
+        Returns the number of records waiting to be read, counted from the
+        block headers of all segments (for pos files without the counts).
+
+        """
+        frnum, offset, index, fwnum = self._load_pos()
+        size = -index
+        for fnum in range(frnum, max(fwnum, self.fwnum) + 1):
+            try:
+                with open(self._segment(fnum), 'rb') as f:
+                    f.seek(max(offset, HEADER.size) if fnum == frnum else HEADER.size)
+                    while True:
+                        data = f.read(BLOCK.size)
+                        if len(data) < BLOCK.size:
+                            break
+                        length, checksum, count, flags = BLOCK.unpack(data)
+                        size += count
+                        f.seek(length, os.SEEK_CUR)
+            except IOError:
+                pass
+        return max(size, 0)
+
+    def get_many(self, max_items, max_wait=None):
+        """
+        Gets up to max_items, waiting up to max_wait seconds for the first one.
+
+        """
+        items = []
+        value = self.get(True, max_wait)
+        while value is not None:
+            items.append(value)
+            if len(items) >= max_items:
+                break
+            value = self.get(False)
+        return items
+
+    def _block(self, records):
+        payload = b''.join(records)
+        flags = 0
+        if self.compress_size is not None and len(payload) >= self.compress_size:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= COMPRESSED
+        return BLOCK.pack(len(payload), crc32(payload), len(records), flags) + payload
+
+    def _write(self, records):
+        data = self._block(records)
         with flock(self.fwrite) as fwrite:
-            marshal.dump((crc32, value), fwrite)
+            fwrite.write(data)
             fwrite.flush()
             os.fsync(fwrite.fileno())
             offset = fwrite.tell()
-        self.sem.release()
+        self._add_written(len(records))
+        for i in range(len(records)):
+            self.sem.release()
         if offset > self.bucket_size:
-            # Switch to a new queue file:
+            # Switch to a new queue segment:
             self._writing(self.fwnum + 1)
+
+    def _group_writer(self):
+        """
+        Writes the records put while waiting for the group window (and
+        while the previous group was being written) as a single block with
+        a single write and fsync, then wakes up the waiting puts.
+
+        """
+        threadpool = gevent.get_hub().threadpool
+        try:
+            while self._records:
+                if self.group_window:
+                    gevent.sleep(self.group_window)
+                records, written = self._records, self._written
+                self._records, self._written = [], AsyncResult()
+                try:
+                    threadpool.apply(self._write, (records,))
+                except Exception as exc:
+                    written.set_exception(exc)
+                else:
+                    written.set(len(records))
+        finally:
+            self._writer = None
+
+    def put(self, value, block=True, timeout=None):
+        """
+        Puts value in the queue, returns once it's durable.
+
+        Concurrent puts are grouped and written with a single fsync.
+
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        record = RECORD.pack(len(data), crc32(data)) + data
+        if self.group_window is None:
+            self._write([record])
+            return
+        self._records.append(record)
+        written = self._written
+        if self._writer is None:
+            self._writer = gevent.spawn(self._group_writer)
+        written.get()
@@ -1,6 +1,6 @@
 from __future__ import absolute_import, unicode_literals
 
-from gevent.queue import Queue
+from gevent.queue import Queue, Empty
 
 import logging
 
@@ -12,3 +12,17 @@ class MemoryQueue(Queue):
         self.name = name
         self.log = log
         super(MemoryQueue, self).__init__()
+
+    def get_many(self, max_items, max_wait=None):
+        """
+        Gets up to max_items, waiting up to max_wait seconds for the first one.
+
+        """
+        items = []
+        try:
+            items.append(self.get(True, max_wait))
+            while len(items) < max_items:
+                items.append(self.get_nowait())
+        except Empty:
+            pass
+        return items
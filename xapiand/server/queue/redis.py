@@ -1,7 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
 import time
-from cPickle import loads, dumps
+from cPickle import loads, dumps, HIGHEST_PROTOCOL
 
 import threading
 import Queue
@@ -9,30 +9,43 @@ import Queue
 import redis
 from redis.exceptions import ConnectionError
 
-from contextlib import contextmanager
-
 import logging
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 6379
 DEFAULT_DB = 0
 
+PUT_CHUNK_SIZE = 1000  # values pushed per LPUSH
+
 
 class VersionMismatch(Exception):
     pass
 
 
 class RedisQueue(object):
+    """
+    Persistent queue stored in redis lists.
+
+    Items are pushed to the head of the list(s) and popped from the tail.
+    All queues share a single (thread-safe) connection pool.
+
+    """
     persistent = True
 
     STOPPED = False
     CONNECTED = False
-    retry = 0
-    _retry = 0
+    retry = 1
+    max_retry = 32
+    _retry_time = 0
     _client = None
-    _lock = threading.RLock()
+    _lock = threading.Lock()  # only used to create the client
     socket_timeout = None
 
+    hostname = DEFAULT_HOST
+    port = DEFAULT_PORT
+    database = DEFAULT_DB
+    password = None
+
     def __init__(self, name=None, log=logging):
         if redis.VERSION < (2, 4, 4):
             raise VersionMismatch(
@@ -48,10 +61,6 @@ class RedisQueue(object):
             name = [name]
         self.names += tuple(name)
         self.keys = tuple('_queue_%s' % n for n in self.names)
-        self.hostname = DEFAULT_HOST
-        self.port = DEFAULT_PORT
-        self.database = DEFAULT_DB
-        self.password = None
 
     def _connparams(self):
         return {'host': self.hostname,
@@ -61,104 +70,109 @@ class RedisQueue(object):
                 'socket_timeout': self.socket_timeout}
 
     def _create_client(self):
-        return redis.Redis(**self._connparams())
+        return redis.Redis(connection_pool=redis.ConnectionPool(**self._connparams()))
 
     @property
     def client(self):
-        if self._client is None:
-            self._client = self._create_client()
-        return self._client
-
-    @contextmanager
-    def conn_or_acquire(self, client=None, retry=True):
-        if not client:
-            client = self.client
-
-        def _conn_or_acquire(stop, retry, try_connecting):
-            self.__class__._lock.acquire()
-            # print 'lock acquired!!', "(pid:%s, tid:%s)" % (os.getpid(), threading.current_thread().ident)
-            try:
-                if self.__class__.STOPPED:
-                    if not stop:
-                        return None
-
-                if retry:
-                    will_retry = self.retry
-                    if will_retry < 32:
-                        will_retry += 2
-                    elif will_retry == 32:
-                        will_retry = 33
-                    else:
-                        will_retry = 32
-                    # print 'retry:', will_retry, self.__class__._retry, "(pid:%s, tid:%s)" % (os.getpid(), threading.current_thread().ident)
-                    if will_retry > self.__class__._retry:
-                        global_retry = will_retry
-                        try_connecting = True
-                    else:
-                        global_retry = will_retry = self.__class__._retry
-                        try_connecting = False
-
-                if try_connecting:
-                    try:
-                        # print 'client.info()', "(pid:%s, tid:%s)" % (os.getpid(), threading.current_thread().ident)
-                        client.info()
-                        self.__class__.CONNECTED = True
-                        if self.__class__._retry != 0:
-                            self.__class__._retry = 0
-                            self.retry = 0
-                            self.logger.info("Connected to redis://%s:%s/%s/", self.hostname, self.port, self.database)
-                        stop = True
-                        return client
-                    except ConnectionError as e:
-                        self.__class__.CONNECTED = False
-                        if retry:
-                            self.retry = will_retry
-                            self.__class__._retry = global_retry
-                            self.logger.error("Cannot connect to redis://%s:%s/%s/: %s. Trying again in %0.2f seconds...", self.hostname, self.port, self.database, e, will_retry)
-                        else:
-                            if not stop:
-                                return None
-                            raise StopIteration
-                elif not retry:
-                    if not stop:
-                        return None
-                    raise StopIteration
-            finally:
-                # print 'lock released!!', "(pid:%s, tid:%s)" % (os.getpid(), threading.current_thread().ident)
-                self.__class__._lock.release()
-
-            for i in range(will_retry):
-                if self.__class__.STOPPED or self.__class__.CONNECTED:
-                    break
-                # print 'sleep! (%s)' % i, "(pid:%s, tid:%s)" % (os.getpid(), threading.current_thread().ident)
-                time.sleep(1)
-            return _conn_or_acquire(stop, False, False)
-
-        yield _conn_or_acquire(False, retry, True)
-
-    def get(self, block, timeout=None):
-        item = None
-        try:
-            with self.conn_or_acquire() as client:
-                if client:
-                    if block and (timeout or timeout is None):
-                        item = client.brpop(self.keys, timeout or 0)
-                        if item:
-                            item = item[1]
-                    else:
-                        item = client.rpop(self.keys)
-        except ConnectionError:
-            item = None
-        if item is None:
+        cls = self.__class__
+        if cls._client is None:
+            with cls._lock:
+                if cls._client is None:
+                    cls._client = self._create_client()
+        return cls._client
+
+    def _connected(self):
+        cls = self.__class__
+        if not cls.CONNECTED:
+            cls.CONNECTED = True
+            cls.retry = 1
+            self.logger.info("Connected to redis://%s:%s/%s/", self.hostname, self.port, self.database)
+
+    def _disconnected(self, exc):
+        """
+        Logs the connection error (backing off, so it's not logged for every
+        operation) and returns the seconds to wait before trying again.
+
+        """
+        cls = self.__class__
+        cls.CONNECTED = False
+        now = time.time()
+        if now >= cls._retry_time:
+            self.logger.error("Cannot connect to redis://%s:%s/%s/: %s. Trying again in %0.2f seconds...", self.hostname, self.port, self.database, exc, cls.retry)
+            cls._retry_time = now + cls.retry
+            cls.retry = min(cls.retry * 2, self.max_retry)
+        return max(cls._retry_time - now, 0)
+
+    def _pop_many(self, client, max_items):
+        """
+        Pops up to max_items (from the tail) of the lists, with a single
+        round-trip per list.
+
+        """
+        items = []
+        for key in self.keys:
+            count = max_items - len(items)
+            if count <= 0:
+                break
+            pipe = client.pipeline()
+            pipe.lrange(key, -count, -1)
+            pipe.ltrim(key, 0, -count - 1)
+            values, _ = pipe.execute()
+            items.extend(reversed(values))
+        return items
+
+    def qsize(self):
+        pipe = self.client.pipeline(transaction=False)
+        for key in self.keys:
+            pipe.llen(key)
+        return sum(pipe.execute())
+
+    def get(self, block=True, timeout=None):
+        # A timeout of 0 doesn't block (BRPOP's 0 would block forever):
+        items = self.get_many(1, timeout if block else 0)
+        if not items:
             raise Queue.Empty
-        return loads(item)
+        return items[0]
+
+    def put(self, value, block=True, timeout=None):
+        self.put_many([value])
 
-    def put(self, value):
+    def put_many(self, values):
+        """
+        Puts all values in the queue, pipelined in a single round-trip.
+
+        """
+        values = [dumps(value, HIGHEST_PROTOCOL) for value in values]
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for i in range(0, len(values), PUT_CHUNK_SIZE):
+                pipe.lpush(self.keys[0], *values[i:i + PUT_CHUNK_SIZE])
+            pipe.execute()
+        except ConnectionError as exc:
+            self._disconnected(exc)
+            raise Queue.Full
+        self._connected()
+
+    def get_many(self, max_items, max_wait=None):
+        """
+        Gets up to max_items, waiting up to max_wait seconds for the first one.
+
+        """
+        if self.STOPPED:
+            return []
+        client = self.client
         try:
-            with self.conn_or_acquire(retry=False) as client:
-                if client:
-                    client.lpush(self.keys[0], dumps(value))
-                    return
-        except ConnectionError:
-            pass
-        raise Queue.Full
+            items = self._pop_many(client, max_items)
+            if not items and (max_wait or max_wait is None):
+                item = client.brpop(self.keys, max_wait or 0)
+                if item:
+                    items = [item[1]]
+                    if max_items > 1:
+                        items.extend(self._pop_many(client, max_items - 1))
+        except ConnectionError as exc:
+            wait = self._disconnected(exc)
+            if max_wait or max_wait is None:
+                time.sleep(min(wait, max_wait or wait))
+            return []
+        self._connected()
+        return [loads(value) for value in items]
@@ -0,0 +1,160 @@
+from __future__ import absolute_import, unicode_literals
+
+import os
+import time
+import Queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import gevent
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import logging
+
+QUEUE_DATABASE = 'Xapian-Queue.sqlite'
+
+
+class SqliteQueue(object):
+    """
+    Persistent queue backed by a SQLite database in WAL mode.
+
+    All queues in the same directory share a database, each with its own
+    table. Items got with ``get_many()`` are only deleted once acknowledged
+    with ``ack()`` (by the writer, after committing them), so a crash before
+    they're committed makes them be delivered again (and so does
+    ``rewind()``, after an error).
+
+    Everything called from the hub (creating the table, puts and sizes) runs
+    in its threadpool, so waiting for the database lock doesn't block it.
+
+    """
+    persistent = True
+
+    STOPPED = False
+
+    synchronous = 'NORMAL'  # WAL is only synced on checkpoints (safe unless the OS crashes)
+    poll_interval = 0.05
+    _local = threading.local()
+
+    def __init__(self, name=None, log=logging):
+        self.name = name
+        self.log = log
+
+        directory, table = os.path.split(name)
+        self.path = os.path.join(directory, QUEUE_DATABASE)
+        self.table = '"%s"' % table.replace('"', '""')
+
+        self.lock = threading.Lock()
+        self.unacked = None
+
+        gevent.get_hub().threadpool.apply(self._create)
+
+    def _create(self):
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY AUTOINCREMENT, value BLOB NOT NULL)' % self.table)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=%s' % self.synchronous)
+        return conn
+
+    def connection(self):
+        """
+        Returns this thread's connection to the queue database.
+
+        """
+        connections = self._local.__dict__.setdefault('connections', {})
+        try:
+            return connections[self.path]
+        except KeyError:
+            conn = connections[self.path] = self._connect()
+            return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def put(self, value, block=True, timeout=None):
+        gevent.get_hub().threadpool.apply(self.put_many, ([value],))
+
+    def put_many(self, values):
+        """
+        Puts all values in the queue in a single transaction.
+
+        """
+        rows = [(sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),) for value in values]
+        with self.transaction() as conn:
+            conn.executemany('INSERT INTO %s (value) VALUES (?)' % self.table, rows)
+
+    def ack(self):
+        """
+        Acknowledges (deletes) the items got so far by ``get_many()``.
+
+        """
+        with self.lock:
+            unacked, self.unacked = self.unacked, None
+            if unacked is not None:
+                with self.transaction() as conn:
+                    conn.execute('DELETE FROM %s WHERE id <= ?' % self.table, (unacked,))
+
+    def rewind(self):
+        """
+        Makes the items got but not yet acknowledged be delivered again by
+        the next ``get_many()`` (after failing to apply them).
+
+        """
+        with self.lock:
+            self.unacked = None
+
+    def qsize(self):
+        """
+        Returns the number of items in the queue (including those got but
+        not yet acknowledged).
+
+        """
+        return gevent.get_hub().threadpool.apply(self._qsize)
+
+    def _qsize(self):
+        # Ids are only ever appended and deleted from the head, so this is
+        # exact (and doesn't scan the table as COUNT(*) would):
+        first, last = self.connection().execute('SELECT MIN(id), MAX(id) FROM %s' % self.table).fetchone()
+        return last - first + 1 if first is not None else 0
+
+    def get_many(self, max_items, max_wait=None):
+        """
+        Gets up to max_items, waiting up to max_wait seconds for the first one.
+
+        The items stay in the queue until acknowledged (see ``ack()``).
+
+        """
+        start = time.time()
+        while True:
+            with self.lock:
+                rows = self.connection().execute('SELECT id, value FROM %s WHERE id > ? ORDER BY id LIMIT ?' % self.table, (self.unacked or 0, max_items)).fetchall()
+                if rows:
+                    self.unacked = rows[-1][0]
+                    return [pickle.loads(bytes(value)) for id, value in rows]
+            if self.STOPPED or max_wait is not None and time.time() - start >= max_wait:
+                return []
+            time.sleep(self.poll_interval)
+
+    def get(self, block=True, timeout=None):
+        items = self.get_many(1, timeout if block else 0)
+        if not items:
+            raise Queue.Empty
+        self.ack()
+        return items[0]
+
@@ -2,18 +2,24 @@ from __future__ import unicode_literals, absolute_import
 
 import os
 import time
+from collections import namedtuple
 from hashlib import md5
 
 from .. import version, json
 from ..exceptions import InvalidIndexError, XapianError
-from ..core import xapian_spawn, DATABASE_SHORT_LIFE
+from ..core import xapian_spawn, shard_endpoints, shard_endpoint, slots, prefixes
 from ..utils import parse_url, build_url, format_time
 from ..parser import index_parser, search_parser, SPLIT_RE
-from ..search import Search
+from ..search import Search, results_cache, queries_cache
+from ..results import RAW_DATA_SEPARATOR
 
 from .base import CommandReceiver, CommandServer, command
+from .commit import queued_weight
 
 QUEUE_WRITER_THREAD = 'Writer-%s'
+DURABLE_TIMEOUT = 60
+
+Route = namedtuple('Route', 'db name queue writer')
 
 
 def database_name(db):
@@ -28,8 +34,8 @@ class XapiandReceiver(CommandReceiver):
         super(XapiandReceiver, self).__init__(*args, **kwargs)
         self._do_create = False
         self._do_reopen = False
-        self._do_init = set()
-        self._inited = {}
+        self._durable = False
+        self._raw_data = False
         self.active_endpoints = None
 
     def dispatch(self, func, line, command):
@@ -40,12 +46,97 @@ class XapiandReceiver(CommandReceiver):
             self._reopen()
         super(XapiandReceiver, self).dispatch(func, line, command)
 
-    def _reopen(self, endpoints=None):
-        endpoints = endpoints or self.active_endpoints
-        if endpoints:
-            self._do_init.add(endpoints)
+    def _reopen(self):
         self._do_reopen = True
 
+    def _ticket(self, count):
+        if self._durable and count:
+            return self.server.writers.ticket(count)
+
+    def _routes(self, endpoints, document_id=None):
+        """
+        Returns the routes to the writers of the endpoints. Sharded endpoints
+        are routed to the shard holding the document (or to all the shards
+        if no document id is given).
+
+        """
+        routes = []
+        for endpoint in endpoints:
+            if document_id is None:
+                routes.extend(self.server.route(db) for db in shard_endpoints(endpoint))
+            else:
+                routes.append(self.server.route(shard_endpoint(endpoint, document_id)))
+        return routes
+
+    def _busy(self, routes):
+        """
+        Returns True (and replies with an error, so the client retries
+        later) if the writer of any of the routes has too many commands
+        waiting.
+
+        """
+        for route in routes:
+            if self.server.writers.busy(route.writer):
+                self.sendLine(">> ERR: [503] Too many pending changes, retry after %d seconds" % self.server.writers.retry_after)
+                return True
+        return False
+
+    def _wait(self, ticket):
+        """
+        Waits (in durable mode) for the changes sent with the ticket to be
+        committed. Returns False (and replies with an error) if they
+        couldn't be.
+
+        """
+        if ticket is None:
+            return True
+        if not ticket.wait(DURABLE_TIMEOUT):
+            self.server.writers.tickets.pop(ticket.id, None)
+            self.sendLine(">> ERR: [504] Timeout waiting for the changes to be committed")
+            return False
+        if ticket.errors:
+            self.sendLine(">> ERR: [500] Unable to commit changes: %s" % ticket.errors[0])
+            return False
+        return True
+
+    @command
+    def durable(self, line=''):
+        """
+        Sets the acknowledgement mode of the connection.
+
+        In durable mode, changes (INDEX, BINDEX, DELETE and COMMIT) are only
+        acknowledged once they have been committed. Changes sent by many
+        clients at the same time are committed together.
+
+        Usage: DURABLE [ON|OFF]
+
+        """
+        mode = line.strip().upper() or 'ON'
+        if mode not in ('ON', 'OFF'):
+            self.sendLine(">> ERR: [400] Invalid mode: %s" % mode)
+            return
+        self._durable = mode == 'ON'
+        self.sendLine(">> OK")
+
+    @command
+    def raw(self, line=''):
+        """
+        Sets the data mode of the connection.
+
+        In raw mode, the data of the results is sent as it was stored (the
+        JSON given when indexing), without decoding and encoding it again.
+        The "data" is then always the last field of the results.
+
+        Usage: RAW [ON|OFF]
+
+        """
+        mode = line.strip().upper() or 'ON'
+        if mode not in ('ON', 'OFF'):
+            self.sendLine(">> ERR: [400] Invalid mode: %s" % mode)
+            return
+        self._raw_data = mode == 'ON'
+        self.sendLine(">> OK")
+
     @command
     def version(self, line):
         """
@@ -87,8 +178,9 @@ class XapiandReceiver(CommandReceiver):
         if endpoint:
             endpoints = (endpoint,)
             try:
+                shard_endpoints(endpoint)
                 self._do_create = True
-                self._reopen(endpoints=endpoints)
+                self._reopen()
                 self.active_endpoints = endpoints
             except InvalidIndexError as exc:
                 self.sendLine(">> ERR: [409] CREATE: %s" % exc)
@@ -104,6 +196,9 @@ class XapiandReceiver(CommandReceiver):
         Local paths as well as remote databases are allowed as endpoints.
         More than one endpoint can be specified, separated by spaces.
 
+        Sharded endpoints (shards://name?n=N) stand for N databases,
+        documents are distributed among them by id.
+
         Usage: OPEN <endpoint> [endpoint ...]
 
         See also: CREATE, USING
@@ -113,8 +208,10 @@ class XapiandReceiver(CommandReceiver):
         if endpoints:
             endpoints = tuple(SPLIT_RE.split(endpoints))
             try:
+                for endpoint in endpoints:
+                    shard_endpoints(endpoint)
                 self._do_create = False
-                self._reopen(endpoints=endpoints)
+                self._reopen()
                 self.active_endpoints = endpoints
             except InvalidIndexError as exc:
                 self.sendLine(">> ERR: [409] OPEN: %s" % exc)
@@ -140,8 +237,10 @@ class XapiandReceiver(CommandReceiver):
         if endpoints:
             endpoints = tuple(SPLIT_RE.split(endpoints))
             try:
+                for endpoint in endpoints:
+                    shard_endpoints(endpoint)
                 self._do_create = True
-                self._reopen(endpoints=endpoints)
+                self._reopen()
                 self.active_endpoints = endpoints
             except InvalidIndexError as exc:
                 self.sendLine(">> ERR: [409] USING: %s" % exc)
@@ -166,7 +265,9 @@ class XapiandReceiver(CommandReceiver):
                     get_size=get_size,
                     data=self.data,
                     log=self.log,
-                    dead=dead)
+                    dead=dead,
+                    cache=results_cache,
+                    raw_data=self._raw_data)
 
                 if counting:
                     search.get_results().next()
@@ -174,7 +275,15 @@ class XapiandReceiver(CommandReceiver):
                 else:
                     try:
                         for result in search.results:
-                            self.sendLine(json.dumps(result, ensure_ascii=False))
+                            raw_data = result.pop('data', None) if self._raw_data else None
+                            if raw_data is None:
+                                self.sendObject(result)
+                            elif self.binary:
+                                result['data'] = raw_data
+                                self.sendObject(result)
+                            else:
+                                result = json.dumps(result, ensure_ascii=False)
+                                self.sendLine("%s%s%s}" % (result[:-1], RAW_DATA_SEPARATOR, raw_data.decode(self.encoding, self.encoding_errors)))
                     except XapianError as exc:
                         self.log.error("%s", exc, exc_info=True)
                         self.sendLine(">> ERR: [500] Unable to get results: %s" % exc)
@@ -182,6 +291,8 @@ class XapiandReceiver(CommandReceiver):
 
                     query_string = str(search.query)
                     self.sendLine("# DEBUG: Parsed query was: %r" % query_string)
+                    if search.round_trips:
+                        self.sendLine("# DEBUG: Database round-trips: %d" % search.round_trips)
                     for warning in search.warnings:
                         self.sendLine("# WARNING: %s" % warning)
                     size = search.size
@@ -267,25 +378,31 @@ class XapiandReceiver(CommandReceiver):
         TERMS <term ...>
     """
 
-    def _init(self):
-        now = time.time()
-        while self._do_init:
-            endpoints = self._do_init.pop()
-            if endpoints not in self._inited or now - self._inited[endpoints] > DATABASE_SHORT_LIFE:
-                queue = self.server.main_queue
-                queue.put(('INIT', endpoints, ()))
-                self._inited[endpoints] = now
-
     def _delete(self, document_id, commit):
         self._reopen()
-        for db in self.active_endpoints:
-            db = build_url(*parse_url(db.strip()))
-            name = database_name(db)
-            queue_name = os.path.join(self.data, name)
-            queue = self.server.get_queue(queue_name)
-            queue.put(('CDELETE' if commit else 'DELETE', (db,), (document_id,)))
-        self.sendLine(">> OK")
-        self._init()
+        routes = self._routes(self.active_endpoints, document_id)
+        if self._busy(routes):
+            return
+        ticket = self._ticket(len(routes))
+        for route in routes:
+            self.server.send(route, ('CDELETE' if commit else 'DELETE', (route.db,), (document_id,)), ticket)
+        if self._wait(ticket):
+            self.sendLine(">> OK")
+
+    def _delete_query(self, line, commit):
+        query = search_parser(line)
+        if not (query.get('search') or query.get('partials') or query.get('terms')):
+            self.sendLine(">> ERR: [400] You must specify a query")
+            return
+        self._reopen()
+        routes = self._routes(self.active_endpoints)
+        if self._busy(routes):
+            return
+        ticket = self._ticket(len(routes))
+        for route in routes:
+            self.server.send(route, ('CDELETE_QUERY' if commit else 'DELETE_QUERY', (route.db,), (query,)), ticket)
+        if self._wait(ticket):
+            self.sendLine(">> OK")
 
     @command(db=True)
     def delete(self, line):
@@ -307,24 +424,50 @@ class XapiandReceiver(CommandReceiver):
         """
         self._delete(line, True)
 
+    @command(db=True)
+    def deletequery(self, line):
+        self._delete_query(line, False)
+    deletequery.__doc__ = """
+    Deletes all documents matching a query.
+
+    Documents matching the query are deleted by the writers in the
+    background, in batches (in durable mode, the reply waits for the
+    whole delete to be committed).
+
+    Usage: DELETEQUERY <query>
+    """ + search_parser.__doc__
+
+    @command(db=True)
+    def cdeletequery(self, line):
+        self._delete_query(line, True)
+    cdeletequery.__doc__ = """
+    Deletes all documents matching a query, and commit.
+
+    Usage: CDELETEQUERY <query>
+    """ + search_parser.__doc__
+
     def _index(self, line, commit, **kwargs):
         result = index_parser(line)
         if isinstance(result, tuple):
             endpoints, document = result
             if not endpoints:
                 endpoints = self.active_endpoints
-            self._reopen(endpoints)
+            self._reopen()
             if not endpoints:
                 self.sendLine(">> ERR: [405] %s" % "You must connect to a database first")
                 return
-            for db in endpoints:
-                db = build_url(*parse_url(db.strip()))
-                name = database_name(db)
-                queue_name = os.path.join(self.data, name)
-                queue = self.server.get_queue(queue_name)
-                queue.put(('CINDEX' if commit else 'INDEX', (db,), (document,)))
-            self.sendLine(">> OK")
-            self._init()
+            try:
+                routes = self._routes(endpoints, document[0])
+            except InvalidIndexError as exc:
+                self.sendLine(">> ERR: [400] %s" % exc)
+                return
+            if self._busy(routes):
+                return
+            ticket = self._ticket(len(routes))
+            for route in routes:
+                self.server.send(route, ('CINDEX' if commit else 'INDEX', (route.db,), (document,)), ticket)
+            if self._wait(ticket):
+                self.sendLine(">> OK")
         else:
             self.sendLine(result)
 
@@ -346,6 +489,75 @@ class XapiandReceiver(CommandReceiver):
     Usage: CINDEX <json>
     """ + index_parser.__doc__
 
+    def _bindex(self, line, commit, **kwargs):
+        try:
+            documents = json.loads(line)
+            if not isinstance(documents, list):
+                raise ValueError("Documents must be a list")
+        except Exception as e:
+            self.sendLine(">> ERR: [400] %s" % e)
+            return
+
+        batches = {}
+        statuses = []
+        queued = 0
+        for i, document in enumerate(documents):
+            document_id = document.get('id') if isinstance(document, dict) else None
+            result = index_parser(document)
+            if isinstance(result, tuple):
+                endpoints, document = result
+                if not endpoints:
+                    endpoints = self.active_endpoints
+                if not endpoints:
+                    result = ">> ERR: [405] %s" % "You must connect to a database first"
+            if isinstance(result, tuple):
+                try:
+                    routes = self._routes(endpoints, document[0])
+                except InvalidIndexError as exc:
+                    result = ">> ERR: [400] %s" % exc
+            if isinstance(result, tuple):
+                self._reopen()
+                for route in routes:
+                    batches.setdefault(route.db, (route, []))[1].append(document)
+                queued += 1
+                status = {'index': i, 'id': document_id, 'status': 'OK'}
+            else:
+                status = {'index': i, 'id': document_id, 'status': 'ERR', 'error': result[8:]}
+            statuses.append(status)
+
+        if self._busy(route for route, batch in batches.values()):
+            return
+        for status in statuses:
+            self.sendObject(status)
+
+        ticket = self._ticket(len(batches))
+        for route, batch in batches.values():
+            self.server.send(route, ('CBINDEX' if commit else 'BINDEX', (route.db,), (batch,)), ticket)
+        if self._wait(ticket):
+            self.sendLine(">> OK: %d documents queued, %d errors" % (queued, len(documents) - queued))
+
+    @command
+    def bindex(self, line):
+        self._bindex(line, False)
+    bindex.__doc__ = """
+    Index a batch of documents.
+
+    Replies with one status line per document, the batch is sent to
+    each writer as a single unit. If any of the writers is busy, the
+    whole batch is rejected.
+
+    Usage: BINDEX [<json>, <json> ...]
+    """ + index_parser.__doc__
+
+    @command
+    def cbindex(self, line):
+        self._bindex(line, True)
+    cbindex.__doc__ = """
+    Index a batch of documents and commit.
+
+    Usage: CBINDEX [<json>, <json> ...]
+    """ + index_parser.__doc__
+
     @command(db=True)
     def commit(self, line=''):
         """
@@ -355,14 +567,43 @@ class XapiandReceiver(CommandReceiver):
 
         """
         self._reopen()
-        for db in self.active_endpoints:
-            db = build_url(*parse_url(db.strip()))
-            name = database_name(db)
-            queue_name = os.path.join(self.data, name)
-            queue = self.server.get_queue(queue_name)
-            queue.put(('COMMIT', (db,), ()), data=self.data, log=self.log)
-        self.sendLine(">> OK")
-        self._init()
+        routes = self._routes(self.active_endpoints)
+        ticket = self._ticket(len(routes))
+        for route in routes:
+            self.server.send(route, ('COMMIT', (route.db,), ()), ticket)
+        if self._wait(ticket):
+            self.sendLine(">> OK")
+
+    @command
+    def compact(self, line=''):
+        """
+        Compacts the database(s) in the background.
+
+        The last committed revision of the database is compacted while both
+        updates and searches keep using the database; updates committed
+        meanwhile are replayed into the compacted database, in a brief
+        pause of its writer, before it replaces the original one.
+
+        Usage: COMPACT [endpoint ...]
+
+        """
+        line = line.strip()
+        endpoints = tuple(SPLIT_RE.split(line)) if line else self.active_endpoints
+        if not endpoints:
+            self.sendLine(">> ERR: [405] %s" % "You must connect to a database first")
+            return
+        try:
+            routes = self._routes(endpoints)
+        except InvalidIndexError as exc:
+            self.sendLine(">> ERR: [400] %s" % exc)
+            return
+        for route in routes:
+            if parse_url(route.db)[0] != 'file':
+                self.sendLine(">> ERR: [400] Only local databases can be compacted: %s" % route.db)
+                return
+        for route in routes:
+            self.server.send(route, ('COMPACT', (route.db,), ()))
+        self.sendLine(">> OK: %d databases being compacted" % len(routes))
 
     @command(internal=True)
     def spawn(self, line=''):
@@ -381,6 +622,24 @@ class XapiandReceiver(CommandReceiver):
             self.sendLine(json.dumps(db_info))
         self.sendLine(">> OK: %d active endpoints" % len(endpoints))
 
+    @command(internal=True)
+    def stats(self, line=''):
+        stats = []
+        for name, cache in (('slots', slots), ('prefixes', prefixes), ('queries', queries_cache), ('results', results_cache)):
+            cache_stats = {'cache': name}
+            cache_stats.update(cache.stats())
+            stats.append(cache_stats)
+        search_stats = {'search': 'databases'}
+        search_stats.update(Search.stats())
+        stats.append(search_stats)
+        output_stats = {'output': 'clients'}
+        output_stats.update(self.output_stats())
+        stats.append(output_stats)
+        stats.extend(self.server.writers.stats())
+        for stat in stats:
+            self.sendLine(json.dumps(stat))
+        self.sendLine(">> OK: %d stats" % len(stats))
+
     @command(internal=True)
     def databases(self, line=''):
         now = time.time()
@@ -408,7 +667,9 @@ class XapiandServer(CommandServer):
 
     def __init__(self, *args, **kwargs):
         self.queues = {}
+        self.routes = {}
         self.databases_pool = kwargs.pop('databases_pool')
+        self.writers = kwargs.pop('writers')
         self.main_queue = kwargs.pop('main_queue')
         self.queue_class = kwargs.pop('queue_class')
         self.data = kwargs.pop('data', '.')
@@ -418,7 +679,42 @@ class XapiandServer(CommandServer):
         self.log.info("Xapiand Server Listening to %s:%s", address, port)
 
     def get_queue(self, name):
-        return self.queues.setdefault(name, self.queue_class(name=name, log=self.log))
+        try:
+            return self.queues[name]
+        except KeyError:
+            return self.queues.setdefault(name, self.queue_class(name=name, log=self.log))
+
+    def route(self, endpoint):
+        """
+        Returns the route (canonical endpoint, writer name, queue and writer)
+        for an endpoint, as given by the clients.
+
+        Routes are cached, only the first time an endpoint is seen the writer
+        is initialized (by the main loop).
+
+        """
+        try:
+            return self.routes[endpoint]
+        except KeyError:
+            pass
+        db = build_url(*parse_url(endpoint.strip()))
+        name = database_name(db)
+        queue = self.get_queue(os.path.join(self.data, name))
+        writer = self.writers.add(db, queue)
+        route = self.routes[endpoint] = Route(db, name, queue, writer)
+        self.main_queue.put(('INIT', (db,), ()))
+        return route
+
+    def send(self, route, msg, ticket=None):
+        """
+        Sends a command to the writer of a route. If a ticket is given, it's
+        done when the writer commits the changes.
+
+        """
+        if ticket is not None:
+            msg += (ticket.id,)
+        route.queue.put(msg)
+        self.writers.notify(route.writer, queued_weight(msg))
 
     def build_client(self, client_socket, address):
         return self.receiver_class(self, client_socket, address, data=self.data, log=self.log)
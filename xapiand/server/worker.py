@@ -3,10 +3,14 @@ from __future__ import unicode_literals, absolute_import
 import os
 import sys
 import time
+import uuid
 import Queue
 import signal
 import threading
 import logging
+import itertools
+import multiprocessing
+from collections import OrderedDict
 
 import gevent
 from gevent import queue
@@ -15,25 +19,34 @@ from gevent.threadpool import ThreadPool
 
 import xapian
 from .. import version
-from ..core import DatabasesPool, xapian_cleanup, DATABASE_MAX_LIFE
+from ..core import Database, DatabasesPool, xapian_cleanup, needs_database, prepare_document, prefixed, DATABASE_MAX_LIFE, DELETE_QUERY_LIMIT, DOCUMENT_ID_TERM_PREFIX
 from ..utils import parse_url, build_url, format_time
 from ..platforms import create_pidlock
 
 from .logging import ColoredStreamHandler
 from .server import XapiandServer, database_name
+from .commit import CommitScheduler, CommitTicket, document_size, queued_weight, COMMIT_TIMEOUT, COMMIT_DOCS, COMMIT_BYTES
+from .compact import Compaction, recover, recover_all, COMPACT_NICE
 
 try:
     from .queue.redis import RedisQueue
 except ImportError:
     RedisQueue = None
 from .queue.fqueue import FileQueue
+from .queue.sqlite import SqliteQueue
 from .queue.memory import MemoryQueue
 
 
 STOPPED = 0
 COMMIT_SLOTS = 10
-COMMIT_TIMEOUT = 1
-WRITERS_POOL_SIZE = 200
+WRITERS_POOL_SIZE = 16
+WRITERS_MAX_OPEN = 100
+WRITERS_BATCH_SIZE = 1000
+WRITERS_TRANSACTIONS = False
+WRITERS_DELETE_BATCH_SIZE = DELETE_QUERY_LIMIT  # documents deleted by a DELETE QUERY between other commands
+PREPARE_MIN_DOCUMENTS = 8
+QUEUE_HIGH = 10000  # documents waiting in a writer queue before rejecting changes
+QUEUE_LOW = 5000  # documents waiting in a writer queue to accept changes again
 COMMANDS_POOL_SIZE = 100
 
 WRITERS_FILE = 'Xapian-Writers.db'
@@ -43,6 +56,7 @@ LOG_FORMAT = "[%(asctime)s: %(levelname)s/%(processName)s:%(threadName)s] %(mess
 DEFAULT_QUEUE = MemoryQueue
 AVAILABLE_QUEUES = {
     'file': FileQueue,
+    'sqlite': SqliteQueue,
     'redis': RedisQueue or DEFAULT_QUEUE,
     'memory': MemoryQueue,
     'persistent': MemoryQueue,
@@ -61,6 +75,21 @@ DATABASE_COMMANDS = {
         lambda a: a[0][0],
         dict(commit=True),
     ),
+    'BINDEX': (
+        'bulk_index',
+        lambda a: '%d documents' % len(a[0]),
+        dict(),
+    ),
+    'CBINDEX': (
+        'bulk_index',
+        lambda a: '%d documents' % len(a[0]),
+        dict(commit=True),
+    ),
+    'PINDEX': (
+        'index_prepared',
+        lambda a: a[0][0],
+        dict(),
+    ),
     'DELETE': (
         'delete',
         lambda a: a[0],
@@ -71,6 +100,11 @@ DATABASE_COMMANDS = {
         lambda a: a[0],
         dict(commit=True),
     ),
+    'DELETE_QUERY': (
+        'delete_query',
+        lambda a: 'up to %d documents' % a[1],
+        dict(),
+    ),
     'COMMIT': (
         'commit',
         lambda a: '',
@@ -78,6 +112,19 @@ DATABASE_COMMANDS = {
     ),
 }
 
+# Deletes by query, run in batches of WRITERS_DELETE_BATCH_SIZE documents:
+DELETE_QUERY_COMMANDS = ('DELETE_QUERY', 'CDELETE_QUERY')
+
+
+# Commands asking for a commit are applied as their plain counterparts,
+# the commit is then done (just once) after the whole batch is applied:
+COMMIT_COMMANDS = {
+    'CINDEX': 'INDEX',
+    'CBINDEX': 'BINDEX',
+    'CDELETE': 'DELETE',
+    'COMMIT': None,
+}
+
 
 class Obj(object):
     def __init__(self, **kwargs):
@@ -88,11 +135,11 @@ def _database_command(database, cmd, args, data='.', log=logging):
     start = time.time()
     try:
         attr, arg, kwargs = DATABASE_COMMANDS[cmd]
-        docid = getattr(database, attr)(*args, **kwargs)
+        result = getattr(database, attr)(*args, **kwargs)
     except Exception as exc:
         log.exception("%s", exc)
         raise
-    docid = ' -> %s' % docid if docid else ''
+    docid = ' -> %s' % result if result else ''
     duration = time.time() - start
     log.debug(
         "Executed command %s(%s)%s ~%s",
@@ -101,109 +148,769 @@ def _database_command(database, cmd, args, data='.', log=logging):
         docid,
         format_time(duration),
     )
+    return result
 
 
-def _database_commit(database, to_commit, commit_lock, timeouts, force=False, data='.', log=logging):
-    if not to_commit:
+def _database_commit(database, scheduler, commit_lock, force=False, data='.', log=logging):
+    if not scheduler.pending:
         return
 
-    now = time.time()
-
-    expires = now - timeouts.commit
-    expires_delayed = now - timeouts.delayed
-    expires_max = now - timeouts.maximum
-
-    for db, (dt0, dt1, dt2) in list(to_commit.items()):
-        do_commit = locked = force and commit_lock.acquire()  # If forcing, wait for the lock
-        if not do_commit:
-            do_commit = dt0 <= expires_max
-            if do_commit:
-                log.warning("Commit maximum expiration reached, commit forced! (%s)", db)
-        if not do_commit:
-            if dt1 <= expires_delayed or dt2 <= expires:
-                do_commit = locked = commit_lock.acquire(False)
-                if not locked:
-                    log.warning("Out of commit slots, commit delayed! (%s)", db)
-        if do_commit:
-            try:
-                _database_command(database, 'COMMIT', (), data=data, log=log)
-                del to_commit[db]
-            finally:
-                if locked:
-                    commit_lock.release()
+    reason = 'forced' if force else scheduler.due()
+    if not reason:
+        return
 
+    if reason in ('forced', 'requested'):
+        locked = commit_lock.acquire()  # If forcing, wait for the lock
+    else:
+        locked = commit_lock.acquire(False)
+        if not locked:
+            if reason != 'maximum':
+                log.warning("Out of commit slots, commit delayed! (%s)", database)
+                return
+            log.warning("Commit maximum expiration reached, commit forced! (%s)", database)
 
-def _writer_loop(databases, databases_pool, db, tq, commit_lock, timeouts, data, log):
-    global STOPPED
-    name = database_name(db)
-    to_commit = {}
+    try:
+        start = time.time()
+        docs, size = scheduler.pending_docs, scheduler.pending_bytes
+        _database_command(database, 'COMMIT', (), data=data, log=log)
+        scheduler.committed(time.time() - start)
+        log.debug("Committed %s documents (~%s bytes, %s)", docs, size, reason)
+    finally:
+        if locked:
+            commit_lock.release()
 
-    current_thread = threading.current_thread()
-    tid = current_thread.name.rsplit('-', 1)[-1]
-    current_thread.name = '%s-%s' % (name[:14], tid)
 
-    start = last = time.time()
+def _database_delete_query(database, job, scheduler, applied=None, data='.', log=logging):
+    """
+    Deletes the next batch of documents matching the query of a delete job,
+    only documents that existed when the job started (and that haven't been
+    written since) are deleted. Returns True once there are no more
+    documents to delete.
+
+    """
+    if job.max_docid is None:
+        job.max_docid = database.database.get_lastdocid()
+    args = (job.query, WRITERS_DELETE_BATCH_SIZE, job.max_docid, tuple(job.written))
+    deleted = _database_command(database, 'DELETE_QUERY', args, data=data, log=log)
+    if applied is not None:
+        applied.append(('DELETE_QUERY', args))
+    if deleted:
+        job.deleted += deleted
+        scheduler.add(deleted, 64 * deleted)
+    done = deleted < WRITERS_DELETE_BATCH_SIZE
+    log.info("Deleted %d documents matching query%s", job.deleted, "" if done else " (so far)")
+    return done
+
+
+def _database_batch(database, commands, scheduler, transaction=False, applied=None, data='.', log=logging):
+    """
+    Applies a batch of commands back-to-back (optionally inside a
+    transaction), letting the commit scheduler know about the changes
+    and about any requested commits. The commands applied are appended
+    to ``applied`` (as they can be replayed by ``_database_command()``).
+
+    Returns the delete jobs (of DELETE QUERY commands) not yet finished,
+    the documents written after them are recorded so their next batches
+    don't delete them (re-indexed documents keep their docids).
+
+    """
+    unfinished = []
+    if transaction:
+        database.begin_transaction(False)
+    try:
+        for cmd, args in commands:
+            if cmd in DELETE_QUERY_COMMANDS:
+                job, = args
+                if not _database_delete_query(database, job, scheduler, applied=applied, data=data, log=log):
+                    unfinished.append(job)
+                elif cmd == 'CDELETE_QUERY':
+                    scheduler.request()
+                continue
+            requested = cmd in COMMIT_COMMANDS
+            if requested:
+                cmd = COMMIT_COMMANDS[cmd]
+            if cmd is not None:
+                _database_command(database, cmd, args, data=data, log=log)
+                if applied is not None:
+                    applied.append((cmd, args))
+                if unfinished:
+                    written = _written_terms(cmd, args)
+                    for job in unfinished:
+                        job.written.update(written)
+                docs, size = document_size(cmd, args)
+                if docs:
+                    scheduler.add(docs, size)
+            if requested:
+                scheduler.request()
+    except Exception:
+        if transaction:
+            database.cancel_transaction()
+            if applied is not None:
+                del applied[:]
+        raise
+    if transaction:
+        database.commit_transaction()
+    return unfinished
+
+
+def _command_ids(cmd, args):
+    if cmd in ('INDEX', 'CINDEX'):
+        return (args[0][0],)
+    elif cmd in ('BINDEX', 'CBINDEX'):
+        return [document[0] for document in args[0]]
+    elif cmd in ('DELETE', 'CDELETE'):
+        return (args[0],)
+    return ()
+
+
+def _written_terms(cmd, args):
+    """
+    Returns the id terms (or docids) of the documents written by a command.
+
+    """
+    if cmd == 'PINDEX':
+        document_ids = (args[0][0],)  # Already prefixed
+    else:
+        document_ids = [prefixed(document_id, DOCUMENT_ID_TERM_PREFIX) if isinstance(document_id, basestring) else document_id for document_id in _command_ids(cmd, args)]
+    return document_ids
+
 
-    # Create a gevent Queue for this thread from the other tread's Queue
-    # (using the raw underlying deque, 'queue'):
-    queue = type(tq)(tq.maxsize)
-    queue.queue = tq.queue
+def _coalesce_commands(commands):
+    """
+    Drops updates (INDEX/DELETE) superseded by a later update of the same
+    document id in the batch, only the last one needs to be applied.
+    Returns the new list of commands and the number of skipped updates.
 
-    database = None
+    """
+    last = {}
+    total = 0
+    for i, (cmd, args) in enumerate(commands):
+        for j, document_id in enumerate(_command_ids(cmd, args)):
+            last[document_id] = (i, j)
+            total += 1
+    if len(last) == total:
+        return commands, 0
 
-    # Open the database
+    skipped = 0
+    coalesced_commands = []
+    for i, (cmd, args) in enumerate(commands):
+        if cmd in ('BINDEX', 'CBINDEX'):
+            documents = [d for j, d in enumerate(args[0]) if last[d[0]] == (i, j)]
+            skipped += len(args[0]) - len(documents)
+            if documents:
+                coalesced_commands.append((cmd, (documents,)))
+                continue
+        elif cmd in ('INDEX', 'CINDEX', 'DELETE', 'CDELETE'):
+            document_id, = _command_ids(cmd, args)
+            if last[document_id] == (i, 0):
+                coalesced_commands.append((cmd, args))
+                continue
+            skipped += 1
+        else:
+            coalesced_commands.append((cmd, args))
+            continue
+        if cmd in COMMIT_COMMANDS:
+            coalesced_commands.append(('COMMIT', ()))  # Keep the requested commit
+    return coalesced_commands, skipped
+
+
+def _prepare_commands(commands, prepare_pool, data='.', log=logging):
+    """
+    Prepares (builds and serialises) the documents to be indexed by a batch
+    of commands using the processes in the prepare pool, so the writer only
+    needs to apply them. Returns the new list of commands.
+
+    """
+    documents = []
+    for cmd, args in commands:
+        if cmd in ('INDEX', 'CINDEX'):
+            documents.append(args[0])
+        elif cmd in ('BINDEX', 'CBINDEX'):
+            documents.extend(args[0])
+    documents = [d for d in documents if not needs_database(d)]
+    if len(documents) < PREPARE_MIN_DOCUMENTS:
+        return commands
+
+    start = time.time()
     try:
-        log.info("New writer %s: %s", name, db)
-        with databases_pool.database((db,), writable=True, create=True) as database:
-            log.debug("Database UUID: %s", database.get_uuid())
-            msg = None
-            timeout = timeouts.timeout
-            while not STOPPED:
-                _database_commit(database, to_commit, commit_lock, timeouts, data=data, log=log)
-
-                now = time.time()
+        prepared = prepare_pool.map(prepare_document, documents, max(len(documents) // 16, 1))
+    except Exception as exc:
+        log.warning("Cannot prepare documents: %s", exc)
+        return commands
+    log.debug("Prepared %d documents ~%s", len(documents), format_time(time.time() - start))
+    prepared = dict(zip(map(id, documents), prepared))
+
+    prepared_commands = []
+    for cmd, args in commands:
+        if cmd in ('INDEX', 'CINDEX', 'BINDEX', 'CBINDEX'):
+            for document in (args[0],) if cmd in ('INDEX', 'CINDEX') else args[0]:
+                try:
+                    prepared_commands.append(('PINDEX', (prepared[id(document)],)))
+                except KeyError:
+                    prepared_commands.append(('INDEX', (document,)))
+            if cmd in ('CINDEX', 'CBINDEX'):
+                prepared_commands.append(('COMMIT', ()))
+        else:
+            prepared_commands.append((cmd, args))
+    return prepared_commands
+
+
+class WriterScheduler(object):
+    """
+    Serves the writer queues of all databases with a fixed number of writer
+    threads.
+
+    Databases with pending commands are put in a ready queue and served, a
+    batch at a time, in round-robin by whichever writer thread is free; a
+    database is never served by more than one thread at a time. Writable
+    databases are kept open in a LRU of up to ``max_open`` databases, so
+    idle databases don't hold a thread.
+
+    Queues are bounded: once ``high`` documents are waiting for a writer, new
+    changes for it are rejected (see ``busy()``) until they drop to ``low``.
+    Bulk commands (BINDEX) count for the documents they carry, any other
+    command counts as one.
+
+    A COMPACT command commits the database and compacts its last committed
+    revision in the background; meanwhile, the writer keeps serving its
+    queue (and committing), recording the commands it applies and the
+    revisions it commits. Once compacted, the writer is paused to replay
+    the commands not in the compacted revision into the compacted
+    database, which is then swapped and the readers using it are reopened.
+
+    """
+    IDLE, READY, BUSY = range(3)
+
+    def __init__(self, databases_pool, commit_lock, commit_policy, prepare_pool=None, max_open=WRITERS_MAX_OPEN, high=QUEUE_HIGH, low=QUEUE_LOW, compact_nice=COMPACT_NICE, data='.', log=logging):
+        self.databases_pool = databases_pool
+        self.commit_lock = commit_lock
+        self.commit_policy = commit_policy
+        self.prepare_pool = prepare_pool
+        self.max_open = max_open
+        self.high = high
+        self.low = min(low, high)
+        self.retry_after = max(int(commit_policy.timeout), 1)
+        self.compact_nice = compact_nice
+        self.data = data
+        self.log = log
+
+        self.writers = {}
+        self.tickets = {}
+        # Ticket ids go in the (maybe persistent) queues, they're unique
+        # to this process so messages left by an earlier run never resolve
+        # tickets of this one:
+        self.ticket_prefix = '%s.' % uuid.uuid4().hex
+        self.ticket_ids = itertools.count(1)
+        self.opened = OrderedDict()
+        self.ready = Queue.Queue()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.time = time.time()
+
+    def __len__(self):
+        return len(self.writers)
+
+    def add(self, db, queue):
+        writer = self.writers.get(db)
+        if writer is None:
+            scheduler = CommitScheduler(
+                timeout=self.commit_policy.commit,
+                maximum=self.commit_policy.maximum,
+                max_docs=self.commit_policy.docs,
+                max_bytes=self.commit_policy.bytes,
+                log=self.log,
+            )
+            path = self._path(db)
+            if path:
                 try:
-                    msg = queue.get(True, timeout)
-                except Queue.Empty:
-                    if now - last > DATABASE_MAX_LIFE:
-                        log.debug("Writer timeout... stopping!")
+                    recover(path, log=self.log)
+                except OSError as e:
+                    self.log.error("Cannot recover interrupted compaction of %s: %s", db, e)
+            try:
+                queued = queue.qsize()  # left behind in a persistent queue
+            except Exception as e:
+                self.log.error("Cannot get size of queue for %s: %s", db, e)
+                queued = 0
+            writer = self.writers[db] = Obj(
+                name=database_name(db),
+                db=db,
+                queue=queue,
+                scheduler=scheduler,
+                state=self.IDLE,
+                dirty=False,
+                expire=False,
+                database=None,
+                context=None,
+                opened=None,
+                tickets=[],
+                last=time.time(),
+                commands=0,
+                skipped=0,
+                deleting=[],
+                deleted=0,
+                compaction=None,
+                compactions=0,
+                queued=queued,
+                dequeued=0,
+                backlog=queued,
+                busy=False,
+                rejected=0,
+            )
+        return writer
+
+    def notify(self, writer, queued=0):
+        """
+        Lets the writer threads know there are commands waiting in the
+        queue of the writer (``queued`` is the weight of the ones just put
+        there, see ``queued_weight()``).
+
+        """
+        with self.lock:
+            writer.queued += queued
+            if writer.state == self.IDLE:
+                writer.state = self.READY
+                self.ready.put(writer.db)
+            elif writer.state == self.BUSY:
+                writer.dirty = True  # Serve again when done
+
+    def tick(self):
+        """
+        Wakes up open writers with pending changes, so they can commit when
+        due, and closes writers which have been idle for too long.
+
+        """
+        now = time.time()
+        if now - self.time < self.commit_policy.timeout:
+            return
+        self.time = now
+        with self.lock:
+            opened = list(self.opened.values())
+        for writer in opened:
+            if now - writer.last > DATABASE_MAX_LIFE:
+                writer.expire = True
+            elif not writer.scheduler.pending:
+                continue
+            self.notify(writer)
+
+    def depth(self, writer):
+        return max(writer.queued - writer.dequeued, 0)
+
+    def busy(self, writer):
+        """
+        Returns True if the writer has too many documents waiting, and
+        counts the rejection. Once busy, the writer stays busy until its
+        queue drains down to the low water mark.
+
+        """
+        depth = self.depth(writer)
+        if writer.busy:
+            writer.busy = depth > self.low
+        else:
+            writer.busy = depth >= self.high
+        if writer.busy:
+            writer.rejected += 1
+        return writer.busy
+
+    def ticket(self, count=1):
+        """
+        Returns a new ticket for a client to wait until the changes sent
+        (to ``count`` writers) with it are committed.
+
+        """
+        ticket = CommitTicket('%s%d' % (self.ticket_prefix, next(self.ticket_ids)), count)
+        self.tickets[ticket.id] = ticket
+        return ticket
+
+    def stop(self, threads):
+        for i in range(threads):
+            self.ready.put(None)  # wake up!
+
+    def stats(self):
+        stats = []
+        for db, writer in list(self.writers.items()):
+            writer_stats = {
+                'writer': writer.name,
+                'endpoint': db,
+                'open': writer.database is not None,
+                'commands': writer.commands,
+                'skipped': writer.skipped,
+                'deleting': len(writer.deleting),
+                'deleted': writer.deleted,
+                'compacting': writer.compaction is not None,
+                'compactions': writer.compactions,
+                'queued': self.depth(writer),
+                'busy': writer.busy,
+                'rejected': writer.rejected,
+            }
+            writer_stats.update(writer.scheduler.stats())
+            stats.append(writer_stats)
+        return stats
+
+    def _resolve(self, tickets, error=None):
+        for ticket_id in tickets:
+            ticket = self.tickets.get(ticket_id)
+            if ticket is not None and ticket.done(error):
+                self.tickets.pop(ticket_id, None)
+
+    def _acquire(self, writer):
+        with self.lock:
+            if writer.state == self.BUSY:
+                writer.dirty = True
+                return False
+            writer.state = self.BUSY
+            writer.dirty = False
+            return True
+
+    def _release(self, writer, again=False):
+        with self.lock:
+            if (again or writer.dirty) and not STOPPED:
+                writer.state = self.READY
+                self.ready.put(writer.db)
+            else:
+                writer.state = self.IDLE
+            writer.dirty = False
+
+    def _queue(self, writer):
+        tq = writer.queue
+        if not isinstance(tq, MemoryQueue):
+            return tq
+        # Use a gevent Queue for this thread from the other tread's Queue
+        # (using the raw underlying deque, 'queue'):
+        queues = self.local.__dict__.setdefault('queues', {})
+        try:
+            queue = queues[writer.db]
+        except KeyError:
+            queue = queues[writer.db] = type(tq)(name=tq.name, log=tq.log)
+            queue.queue = tq.queue
+        return queue
+
+    def _open(self, writer):
+        if writer.database is None:
+            self._evict()
+            context = self.databases_pool.database((writer.db,), writable=True, create=True)
+            writer.database = context.__enter__()
+            writer.context = context
+            writer.opened = time.time()
+            self.log.info("New writer %s: %s", writer.name, writer.db)
+            self.log.debug("Database UUID: %s", writer.database.get_uuid())
+        with self.lock:
+            self.opened.pop(writer.db, None)
+            self.opened[writer.db] = writer
+        return writer.database
+
+    def _close(self, writer):
+        database = writer.database
+        if database is None:
+            return
+        error = None
+        try:
+            _database_commit(database, writer.scheduler, self.commit_lock, force=True, data=self.data, log=self.log)
+            self._committed(writer)
+            self._ack(writer)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            tickets, writer.tickets = writer.tickets, []
+            self._resolve(tickets, error)
+            with self.lock:
+                self.opened.pop(writer.db, None)
+            context, writer.context = writer.context, None
+            writer.database = None
+            writer.expire = False
+            database.close()
+            context.__exit__(None, None, None)
+            self.log.info("Writer %s closed! ~ open for %s", writer.name, format_time(time.time() - writer.opened))
+
+    def _path(self, db):
+        """
+        Returns the path of a local database (None for other endpoints).
+
+        """
+        scheme, hostname, port, username, password, path, query, query_dict = parse_url(db)
+        if scheme != 'file':
+            return None
+        if path[0] not in ('/', '.'):
+            path = os.path.join(self.data, path)
+        return path
+
+    def _committed(self, writer):
+        """
+        Lets the compaction of the writer (if compacting) know the revision
+        committed last, so it knows which commands are in it.
+
+        """
+        if writer.compaction is not None and writer.database is not None:
+            (uuid, revision), = writer.database.get_revisions()
+            writer.compaction.committed(revision)
+
+    def _compact(self, writer):
+        """
+        Starts compacting the database of the (committed) writer in the
+        background. The writer keeps serving meanwhile, recording the
+        commands it applies.
+
+        """
+        if writer.compaction is not None:
+            self.log.warning("Writer %s already compacting: %s", writer.name, writer.db)
+            return
+        path = self._path(writer.db)
+        if not path:
+            self.log.error("Writer %s: Only local databases can be compacted: %s", writer.name, writer.db)
+            return
+        revisions = self._open(writer).get_revisions()
+        if revisions is None:
+            self.log.error("Writer %s: Compacting databases needs xapian >= 1.4: %s", writer.name, writer.db)
+            return
+        (uuid, revision), = revisions
+        compaction = Compaction(path, revision, nice=self.compact_nice, callback=lambda: self.notify(writer), log=self.log)
+        try:
+            compaction.start()
+        except Exception as e:
+            compaction.discard()
+            self.log.error("Writer %s cannot compact: %s", writer.name, e)
+            return
+        writer.compaction = compaction
+        self.log.info("Writer %s compacting: %s", writer.name, writer.db)
+
+    def _compacted(self, writer):
+        """
+        Commits and closes the writer, replays the commands recorded while
+        compacting into the compacted database, swaps it for the database
+        of the writer and makes the readers reopen it.
+
+        """
+        self._close(writer)
+        compaction, writer.compaction = writer.compaction, None
+        try:
+            if compaction.error:
+                raise compaction.error
+            start = time.time()
+            database = Database((compaction.target,), writable=True, create=False, data=self.data, log=self.log)
+            replayed = 0
+            try:
+                for cmd, args in compaction.replay():
+                    _database_command(database, cmd, args, data=self.data, log=self.log)
+                    replayed += 1
+                database.commit()
+            finally:
+                database.close()
+            self.log.debug("Writer %s replayed %d commands ~ replaying took %s", writer.name, replayed, format_time(time.time() - start))
+            compaction.swap()
+        except Exception as e:
+            compaction.discard()
+            self.log.error("Writer %s cannot compact: %s", writer.name, e)
+            return
+        writer.compactions += 1
+        self.databases_pool.invalidate(writer.db)
+
+    def _dequeued(self, writer, msgs):
+        """
+        Counts the messages got from the queue of the writer by their weight
+        (the backlog left by an earlier run was counted as one per message,
+        so it's taken the same way), resyncing the counts once the queue is
+        found empty.
+
+        """
+        backlog = min(writer.backlog, len(msgs))
+        weight = backlog + sum(queued_weight(msg) for msg in msgs[backlog:])
+        with self.lock:
+            writer.backlog -= backlog
+            if msgs:
+                writer.dequeued += weight
+            else:
+                writer.dequeued = writer.queued
+                writer.backlog = 0
+
+    def _ack(self, writer):
+        """
+        Acknowledges the commands got from the queue of the writer (if the
+        queue needs it) once they're all committed, so they're delivered
+        again after a crash until then.
+
+        """
+        ack = getattr(writer.queue, 'ack', None)
+        if ack is None or writer.scheduler.pending or writer.deleting:
+            return
+        try:
+            ack()
+        except Exception as e:
+            self.log.error("Writer %s: Cannot acknowledge queued commands: %s", writer.name, e)
+
+    def _rewind(self, writer):
+        """
+        Makes the queue of the writer (if it needs it) deliver again the
+        commands got since they were last acknowledged, after failing to
+        apply them, so they're not acknowledged once it's closed.
+
+        """
+        rewind = getattr(writer.queue, 'rewind', None)
+        if rewind is None:
+            return
+        try:
+            rewind()
+        except Exception as e:
+            self.log.error("Writer %s: Cannot rewind queued commands: %s", writer.name, e)
+
+    def _evict(self):
+        """
+        Closes the least recently used writers (that are not busy) while
+        there are too many open.
+
+        """
+        while True:
+            with self.lock:
+                if len(self.opened) < self.max_open:
+                    return
+                for victim in self.opened.values():
+                    if victim.state != self.BUSY:
+                        victim.state = self.BUSY
+                        victim.dirty = False
                         break
+                else:
+                    return  # All open writers are busy
+            try:
+                self._close(victim)
+            finally:
+                self._release(victim)
+
+    def _serve(self, writer):
+        """
+        Serves the next batch of every unfinished DELETE QUERY, followed by a
+        batch of commands from the queue of a writer. Returns True if there
+        might be more commands waiting (or more documents to delete).
+
+        """
+        if writer.compaction is not None and writer.compaction.done:
+            self._compacted(writer)
+
+        msgs = self._queue(writer).get_many(WRITERS_BATCH_SIZE, 0)
+        self._dequeued(writer, msgs)
+
+        commands = []
+        tickets = []
+        compact = False
+        for msg in msgs:
+            if not msg:
+                continue
+            try:
+                cmd, endpoints, args = msg[:3]
+            except ValueError:
+                self.log.error("Wrong command received!")
+                continue
+
+            if writer.db in endpoints:
+                if cmd == 'COMPACT':
+                    compact = True
                     continue
-                if not msg:
+                if cmd in DELETE_QUERY_COMMANDS:
+                    # Tickets wait for the whole delete to be committed:
+                    job = Obj(cmd=cmd, query=args[0], max_docid=None, deleted=0, written=set(), tickets=list(msg[3:]))
+                    commands.append((cmd, (job,)))
                     continue
+                commands.append((cmd, args))
+                if len(msg) > 3:
+                    tickets.append(msg[3])  # Waiting for the commit
+
+        received = len(commands)
+        # Unfinished deletes go first (they were received before):
+        commands[:0] = [(unfinished_job.cmd, (unfinished_job,)) for unfinished_job in writer.deleting]
+        jobs = [command_args[0] for command, command_args in commands if command in DELETE_QUERY_COMMANDS]
+        writer.deleting = []
+
+        if not commands and writer.expire:
+            self._close(writer)
+            return False
+
+        database = self._open(writer)
+        if commands:
+            writer.last = time.time()
+            writer.expire = False
+            writer.commands += received
+            commands, skipped = _coalesce_commands(commands)
+            if skipped:
+                writer.skipped += skipped
+                self.log.debug("Skipped %d superseded updates", skipped)
+            if self.prepare_pool:
+                commands = _prepare_commands(commands, self.prepare_pool, data=self.data, log=self.log)
+            deleted = sum(job.deleted for job in jobs)
+            # Commands applied while compacting are replayed into the compacted database:
+            applied = [] if writer.compaction is not None else None
+            try:
+                unfinished = _database_batch(database, commands, writer.scheduler, transaction=WRITERS_TRANSACTIONS and len(commands) > 1, applied=applied, data=self.data, log=self.log)
+            except Exception as e:
+                self._resolve(tickets + [t for failed_job in jobs for t in failed_job.tickets], e)
+                raise
+            finally:
+                if applied:
+                    writer.compaction.record(applied)
+            writer.deleted += sum(job.deleted for job in jobs) - deleted
+            for job in jobs:
+                if job in unfinished:
+                    writer.deleting.append(job)
+                else:
+                    tickets.extend(job.tickets)
+        if tickets:
+            # All tickets waiting for this batch share a single commit
+            writer.tickets.extend(tickets)
+            writer.scheduler.request()
+        # Compactions start from a committed revision:
+        _database_commit(database, writer.scheduler, self.commit_lock, force=compact, data=self.data, log=self.log)
+        self._committed(writer)
+        self._ack(writer)
+        if writer.tickets and not writer.scheduler.pending:
+            tickets, writer.tickets = writer.tickets, []
+            self._resolve(tickets)
+        if compact:
+            self._compact(writer)
+        return len(msgs) >= WRITERS_BATCH_SIZE or bool(writer.deleting)
+
+    def serve(self):
+        """
+        Writer thread main loop.
+
+        """
+        current_thread = threading.current_thread()
+        tid = current_thread.name.rsplit('-', 1)[-1]
+        current_thread.name = 'Writer-%s' % tid
+
+        while not STOPPED:
+            db = self.ready.get()
+            if db is None:
+                break
+            writer = self.writers[db]
+            if not self._acquire(writer):
+                continue
+            more = False
+            try:
+                more = self._serve(writer)
+            except Exception as e:
+                self.log.error("Writer %s ERROR: %s", writer.name, e)
+                self._rewind(writer)
                 try:
-                    cmd, endpoints, args = msg
-                except ValueError:
-                    log.error("Wrong command received!")
-                    continue
+                    self._close(writer)
+                except Exception as e:
+                    self.log.error("Writer %s ERROR: %s", writer.name, e)
+            finally:
+                self._release(writer, more)
 
-                for _db in endpoints:
-                    _db = build_url(*parse_url(_db.strip()))
-                    if _db != db:
-                        continue
-
-                    last = now
-                    _database_command(database, cmd, args, data=data, log=log)
-
-                    if cmd in ('INDEX', 'DELETE'):
-                        now = time.time()
-                        if db in to_commit:
-                            to_commit[db] = (to_commit[db][0], to_commit[db][1], now)
-                        else:
-                            to_commit[db] = (now, now, now)
-    except Exception as e:
-        log.error("Writer ERROR: %s", e)
-    finally:
-        if database:
-            _database_commit(database, to_commit, commit_lock, timeouts, force=True, data=data, log=log)
-            database.close()
-        databases.pop(db, None)
-        log.info("Writer %s ended! ~ lived for %s", name, format_time(time.time() - start))
+    def close(self):
+        """
+        Commits and closes all open writers.
+
+        """
+        for writer in list(self.opened.values()):
+            try:
+                self._close(writer)
+            except Exception as e:
+                self.log.error("Writer %s ERROR: %s", writer.name, e)
 
 
 def xapiand_run(data=None, logfile=None, pidfile=None, uid=None, gid=None, umask=0,
         working_directory=None, verbosity=1, commit_slots=None, commit_timeout=None,
-        listener=None, queue_type=None, **options):
+        commit_docs=None, commit_bytes=None, prepare_workers=None, writer_threads=None,
+        writer_handles=None, group_window=None, queue_high=None, queue_low=None, compact_nice=None, listener=None,
+        queue_type=None, **options):
     global STOPPED
 
     current_thread = threading.current_thread()
@@ -238,27 +945,60 @@ def xapiand_run(data=None, logfile=None, pidfile=None, uid=None, gid=None, umask
 
     if commit_timeout is None:
         commit_timeout = COMMIT_TIMEOUT
+
+    if commit_docs is None:
+        commit_docs = COMMIT_DOCS
+
+    if commit_bytes is None:
+        commit_bytes = COMMIT_BYTES
+
+    if not writer_threads:
+        writer_threads = WRITERS_POOL_SIZE
+
+    if not writer_handles:
+        writer_handles = WRITERS_MAX_OPEN
+
+    if not queue_high:
+        queue_high = QUEUE_HIGH
+
+    if queue_low is None:
+        queue_low = min(QUEUE_LOW, queue_high // 2)
+
+    if compact_nice is None:
+        compact_nice = COMPACT_NICE
     timeout = min(max(int(round(commit_timeout * 0.3)), 1), 3)
 
     queue_class = AVAILABLE_QUEUES.get(queue_type) or AVAILABLE_QUEUES['default']
-    mode = "with multiple threads and %s commit slots using %s" % (commit_slots, queue_class.__name__)
+    if group_window is not None and hasattr(queue_class, 'group_window'):
+        queue_class.group_window = group_window / 1000000.0
+    mode = "with %s writer threads and %s commit slots using %s" % (writer_threads, commit_slots, queue_class.__name__)
     log.warning("Starting Xapiand Server v%s (xapian v%s) %s [%s] (pid:%s)", version, xapian.version_string(), mode, loglevel, os.getpid())
 
     commit_lock = Semaphore(commit_slots)
-    timeouts = Obj(
+    commit_policy = Obj(
         timeout=timeout,
         commit=commit_timeout * 1.0,
-        delayed=commit_timeout * 3.0,
         maximum=commit_timeout * 9.0,
+        docs=commit_docs,
+        bytes=commit_bytes,
     )
 
+    # Start the prepare pool processes before any thread is started:
+    prepare_pool = multiprocessing.Pool(prepare_workers) if prepare_workers else None
+
+    try:
+        recover_all(data, log=log)
+    except OSError as exc:
+        log.error("Cannot recover interrupted compactions: %s", exc)
+
     main_queue = queue.Queue()
     databases_pool = DatabasesPool(data=data, log=log)
-    databases = {}
+    writers = WriterScheduler(databases_pool, commit_lock, commit_policy, prepare_pool, max_open=writer_handles, high=queue_high, low=queue_low, compact_nice=compact_nice, data=data, log=log)
 
     xapian_server = XapiandServer(
         (address, port),
         databases_pool=databases_pool,
+        writers=writers,
         pool_size=COMMANDS_POOL_SIZE,
         main_queue=main_queue,
         queue_class=queue_class,
@@ -276,44 +1016,34 @@ def xapiand_run(data=None, logfile=None, pidfile=None, uid=None, gid=None, umask
         log.error("Cannot start server: %s", exc)
         sys.exit(-1)
 
-    pool_size = WRITERS_POOL_SIZE
-    pool_size_warning = int(pool_size / 3.0 * 2.0)
-    writers_pool = ThreadPool(pool_size)
+    writers_pool = ThreadPool(writer_threads)
+    threads = [writers_pool.spawn(writers.serve) for i in range(writer_threads)]
 
     def start_writer(db):
         db = build_url(*parse_url(db.strip()))
         name = database_name(db)
-        try:
-            tq = None
-            t, tq = databases[db]
-            if t.ready():
-                raise KeyError
-        except KeyError:
-            queue_name = os.path.join(data, name)
-            tq = tq or xapian_server.get_queue(queue_name)
-            pool_used = len(writers_pool)
-            if not (pool_size_warning - pool_used) % 10:
-                log.warning("Writers pool is close to be full (%s/%s)", pool_used, pool_size)
-            elif pool_used == pool_size:
-                log.error("Writers poll is full! (%s/%s)", pool_used, pool_size)
-            t = writers_pool.spawn(_writer_loop, databases, databases_pool, db, tq, commit_lock, timeouts, data, log)
-            databases[db] = (t, tq)
-        return db, name, t, tq
+        queue_name = os.path.join(data, name)
+        tq = xapian_server.get_queue(queue_name)
+        writer = writers.add(db, tq)
+        return db, name, tq, writer
 
     if queue_class.persistent:
         # Initialize seen writers:
         writers_file = os.path.join(data, WRITERS_FILE)
-        with open(writers_file, 'rt') as epfile:
-            for i, db in enumerate(epfile):
-                if i == 0:
-                    log.debug("Initializing writers...")
-                start_writer(db)
+        if os.path.exists(writers_file):
+            with open(writers_file, 'rt') as epfile:
+                for i, db in enumerate(epfile):
+                    if i == 0:
+                        log.debug("Initializing writers...")
+                    db, name, tq, writer = start_writer(db)
+                    writers.notify(writer)
 
     log.info("Waiting for commands...")
     msg = None
-    timeout = timeouts.timeout
+    timeout = commit_policy.timeout
     while not xapian_server.closed:
         xapian_cleanup(databases_pool, DATABASE_MAX_LIFE, data=data, log=log)
+        writers.tick()
         try:
             msg = main_queue.get(True, timeout)
         except Queue.Empty:
@@ -327,13 +1057,18 @@ def xapiand_run(data=None, logfile=None, pidfile=None, uid=None, gid=None, umask
             continue
 
         for db in endpoints:
-            db, name, t, tq = start_writer(db)
+            db, name, tq, writer = start_writer(db)
             if cmd != 'INIT':
+                msg = (cmd, (db,), args)
                 try:
-                    tq.put((cmd, db, args))
+                    tq.put(msg)
                     log.debug("Command '%s' forwarded to %s", cmd, name)
                 except Queue.Full:
                     log.error("Cannot send command to queue! (2)")
+                else:
+                    writers.notify(writer, queued_weight(msg))
+                    continue
+            writers.notify(writer)
 
     log.debug("Waiting for connected clients to disconnect...")
     while True:
@@ -346,23 +1081,25 @@ def xapiand_run(data=None, logfile=None, pidfile=None, uid=None, gid=None, umask
     queue_class.STOPPED = STOPPED = time.time()
     if queue_class.persistent:
         with open(writers_file, 'wt') as epfile:
-            for db, (t, tq) in databases.items():
-                if not t.ready():
-                    epfile.write("%s\n" % db)
+            for db in writers.writers:
+                epfile.write("%s\n" % db)
 
     # Wake up writers:
-    for t, tq in databases.values():
-        try:
-            tq.put(None)  # wake up!
-        except Queue.Full:
-            log.error("Cannot send command to queue! (1)")
+    writers.stop(writer_threads)
 
-    log.debug("Waiting for %s writers...", len(databases))
-    for t, tq in databases.values():
+    log.debug("Waiting for %s writer threads...", writer_threads)
+    for t in threads:
         t.wait()
 
+    log.debug("Closing %s open writers...", len(writers.opened))
+    writers_pool.spawn(writers.close).wait()
+
     xapian_cleanup(databases_pool, 0, data=data, log=log)
 
+    if prepare_pool:
+        prepare_pool.close()
+        prepare_pool.join()
+
     log.warning("Xapiand Server ended! (pid:%s)", os.getpid())
 
     gevent.wait()
@@ -2,7 +2,10 @@ from __future__ import unicode_literals, absolute_import, division
 
 import re
 import socket
+import struct
 import datetime
+import threading
+from collections import OrderedDict
 
 try:
     from dateutil.tz import tzoffset
@@ -159,6 +162,119 @@ def format_time(timespan, precision=3):
     return ret
 
 
+class MemoizedTable(dict):
+    """
+    Bounded table of memoized results for a function of a single (hashable)
+    argument, with hits/misses counters. When the table is full it's cleared.
+
+    """
+    def __init__(self, func, maxsize=10000):
+        super(MemoizedTable, self).__init__()
+        self.func = func
+        self.maxsize = maxsize
+        self.lookups = 0
+        self.misses = 0
+
+    def __missing__(self, key):
+        self.misses += 1
+        if len(self) >= self.maxsize:
+            self.clear()
+        value = self[key] = self.func(key)
+        return value
+
+    def __call__(self, key):
+        self.lookups += 1
+        return self[key]
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.lookups - self.misses,
+            'misses': self.misses,
+        }
+
+
+class LRUCache(object):
+    """
+    Least recently used cache, bounded by the (approximate) size in bytes of
+    the values, with hits/misses/evictions counters.
+
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """
+        Adds the value (of the given size), evicting the least recently used
+        values as needed. Values larger than the whole cache are not added.
+
+        """
+        if size > self.maxbytes:
+            return False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+            while self._entries and self.bytes + size > self.maxbytes:
+                _, entry = self._entries.popitem(last=False)
+                self.bytes -= entry[1]
+                self.evictions += 1
+            self._entries[key] = (value, size)
+            self.bytes += size
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self.bytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / (self.hits + self.misses), 4) if self.hits + self.misses else 0,
+        }
+
+
+def sizeof(value):
+    """
+    Approximate size in bytes of a (JSON-like) value.
+
+    """
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.items()) + 32
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value) + 16
+    if isinstance(value, basestring):
+        return len(value) + 8
+    return 8
+
+
 def sendall(client_socket, string, encoding='utf-8', encoding_errors='strict'):
     client_socket.sendall(string.encode(encoding, encoding_errors))
 
@@ -188,3 +304,87 @@ def readline(client_socket, bufsize=4096, encoding='utf-8', encoding_errors='str
     if buf:
         yield buf.decode(encoding, encoding_errors)
     yield ""
+
+
+# Frames of the binary protocol: a 4 bytes (big-endian) length followed by
+# the payload.
+FRAME_HEADER = struct.Struct(str('!I'))
+FRAME_MAX_SIZE = 64 * 1024 * 1024  # larger frames are rejected
+
+
+def pack_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class SocketReader(object):
+    """
+    Reads lines or frames (see pack_frame) from a socket, so the protocol
+    can be switched in the middle of a connection.
+
+    """
+    def __init__(self, client_socket, bufsize=4096, encoding='utf-8', encoding_errors='strict', max_frame_size=FRAME_MAX_SIZE):
+        self.client_socket = client_socket
+        self.bufsize = bufsize
+        self.max_frame_size = max_frame_size
+        self.encoding = encoding
+        self.encoding_errors = encoding_errors
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def _recv(self, size=0):
+        if self.eof:
+            return False
+        try:
+            more = self.client_socket.recv(max(size, self.bufsize))
+        except (socket.error, socket.timeout):
+            more = None
+        if not more:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def readline(self):
+        """
+        Returns the next line (with its delimiter), or "" at the end.
+
+        """
+        start = self.pos
+        while True:
+            end = self.buf.find(b"\n", start)
+            if end != -1:
+                line = self.buf[self.pos:end + 1]
+                self.pos = end + 1
+                break
+            start = len(self.buf) - self.pos
+            if not self._recv():
+                line = self.buf[self.pos:]
+                self.buf, self.pos = b'', 0
+                break
+            start += self.pos
+        return line.decode(self.encoding, self.encoding_errors)
+
+    def read_frame(self):
+        """
+        Returns the payload of the next frame, or None at the end. Raises
+        ValueError for frames larger than ``max_frame_size`` (the stream
+        can't be read any further).
+
+        """
+        while len(self.buf) - self.pos < FRAME_HEADER.size:
+            if not self._recv():
+                return
+        size, = FRAME_HEADER.unpack_from(self.buf, self.pos)
+        if size > self.max_frame_size:
+            raise ValueError("Frame too large (%d bytes, the maximum is %d)" % (size, self.max_frame_size))
+        end = self.pos + FRAME_HEADER.size + size
+        while len(self.buf) < end:
+            missing = end - len(self.buf)
+            if not self._recv(missing):
+                return
+            end = FRAME_HEADER.size + size
+        payload = self.buf[end - size:end]
+        self.pos = end
+        return payload